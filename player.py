@@ -1,17 +1,32 @@
+# Imported first, so that --profile-startup can measure the imports below
+import startup_profiler
 from PyQt5.QtWidgets import (QApplication, QWidget, QPushButton, QHBoxLayout, QVBoxLayout, QStyle, QSlider, QFileDialog,
-                             QMainWindow, QLabel, QShortcut, QSizePolicy)
-from PyQt5.QtGui import QIcon, QPixmap, QPainter, QCloseEvent
+                             QMainWindow, QLabel, QShortcut, QSizePolicy, QListView)
+from PyQt5.QtGui import QIcon, QPixmap, QPainter, QCloseEvent, QImage, QImageReader
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
-from PyQt5.QtMultimediaWidgets import QVideoWidget
-from PyQt5.QtCore import Qt, QUrl, QTimer, QSize, QEvent
-from mutagen.mp3 import MP3
-from mutagen.mp4 import MP4, MP4Cover
-from mutagen.flac import FLAC
-from mutagen.id3 import ID3, APIC
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+from PyQt5.QtCore import (Qt, QUrl, QTimer, QSize, QEvent, QObject, QRunnable, QThreadPool, pyqtSignal, QBuffer,
+                          QByteArray, QIODevice, QAbstractListModel, QModelIndex, QPoint,
+                          QFileSystemWatcher)
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+import errno
+import functools
+import getpass
+import hashlib
 import json
+import select
+import sqlite3
+import struct
 import sys
 import os
+import pathlib
+import threading
+import time
+
+if startup_profiler.profiler:
+    startup_profiler.profiler.mark('imports done')
 
 
 # Transforms relative path to absolute path
@@ -24,6 +39,27 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+# Decodes an image straight to a size which fits into max_size x max_size,
+# so that huge album covers never take their full resolution in memory
+def decode_image(data, max_size):
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    size = reader.size()
+    if size.isValid() and (size.width() > max_size or size.height() > max_size):
+        reader.setScaledSize(size.scaled(max_size, max_size, Qt.KeepAspectRatio))
+    return reader.read()
+
+
+# Largest side of the screens, covers are never shown bigger than that. Must be called from the GUI thread
+def cover_size_limit():
+    screens = QApplication.screens()
+    if not screens:
+        return DEFAULT_COVER_SIZE_LIMIT
+    return max(max(screen.size().width(), screen.size().height()) for screen in screens)
+
+
 # Custom slider allows to instantly move handle to the current mouse click position
 class VolumeSlider(QSlider):
     def __init__(self, orientation=Qt.Horizontal, parent=None):
@@ -38,29 +74,1728 @@ class VolumeSlider(QSlider):
 
 
 # Custom label allows to resize image inside of it while keeping aspect ratio
+# Scaled images are cached per label size, so repaints don't rescale the full-resolution image
 class ImageLabel(QLabel):
     def __init__(self):
         super().__init__()
         self.pixmap = QPixmap()
+        # Smoothly scaled pixmaps by label size (width, height)
+        self.scaled_pixmaps = {}
+
+        # Timer to render the image smoothly once resizing is finished
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(RESIZE_SETTLE_DELAY)
+        self.resize_timer.timeout.connect(self.update)
 
     def setPixmap(self, tag_data):
-        if not self.pixmap.loadFromData(tag_data):
-            print("Failed to load pixmap:", tag_data)
+        image = decode_image(tag_data, cover_size_limit())
+        if image.isNull():
+            print("Failed to load pixmap:", tag_data[:16])
+        self.pixmap = QPixmap.fromImage(image)
+        self.scaled_pixmaps.clear()
         self.update()
 
     def setPixmapPath(self, pixmap_path):
         if not self.pixmap.load(pixmap_path):
             print("Failed to load pixmap:", resource_path(pixmap_path))
+        self.scaled_pixmaps.clear()
         self.update()
 
+    def scaled_pixmap(self, size):
+        key = (size.width(), size.height())
+        scaled_pixmap = self.scaled_pixmaps.get(key)
+        if scaled_pixmap is None:
+            if self.resize_timer.isActive():
+                # Fast (but rough) scaling while the label is being resized, it's not cached
+                return self.pixmap.scaled(size, Qt.KeepAspectRatio, Qt.FastTransformation)
+            scaled_pixmap = self.pixmap.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            if len(self.scaled_pixmaps) >= SCALED_PIXMAP_CACHE_SIZE:
+                # Remove the oldest size
+                del self.scaled_pixmaps[next(iter(self.scaled_pixmaps))]
+            self.scaled_pixmaps[key] = scaled_pixmap
+        return scaled_pixmap
+
     def paintEvent(self, event):
         painter = QPainter(self)
         rect = self.rect()
         if not self.pixmap.isNull():
-            scaled_pixmap = self.pixmap.scaled(rect.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            scaled_pixmap = self.scaled_pixmap(rect.size())
             point = rect.center() - scaled_pixmap.rect().center()
             painter.drawPixmap(point, scaled_pixmap)
 
+    def resizeEvent(self, event):
+        self.resize_timer.start()
+        super().resizeEvent(event)
+
+
+# Returns album cover image data of a music file or None if it doesn't have one
+def read_album_cover(file_path):
+    tags = read_media_tags(file_path)
+    return tags['cover'] if tags else None
+
+
+# Returns title, artist, album, duration (seconds) and cover image data of a media file,
+# or None if mutagen can't read tags of its format.
+# mutagen is imported on first use, it's not needed for the startup
+def read_media_tags(file_path):
+    if file_path.endswith('.mp3'):
+        from mutagen.mp3 import MP3
+        from mutagen.id3 import ID3, APIC
+
+        audio = MP3(file_path, ID3=ID3)
+        cover = next((tag.data for tag in (audio.tags or {}).values() if isinstance(tag, APIC)), None)
+        keys = ('TIT2', 'TPE1', 'TALB')
+    elif file_path.endswith('.flac'):
+        from mutagen.flac import FLAC
+        audio = FLAC(file_path)
+        cover = audio.pictures[0].data if audio.pictures else None
+        keys = ('title', 'artist', 'album')
+    elif file_path.endswith(('.m4a', '.mp4')):
+        from mutagen.mp4 import MP4, MP4Cover
+        audio = MP4(file_path)
+        cover = next((bytes(cover) for cover in (audio.tags or {}).get('covr', [])
+                      if cover.imageformat in (MP4Cover.FORMAT_JPEG, MP4Cover.FORMAT_PNG)), None)
+        keys = ('\xa9nam', '\xa9ART', '\xa9alb')
+    else:
+        return None
+    title, artist, album = (first_tag_value(audio.tags, key) for key in keys)
+    return {'title': title, 'artist': artist, 'album': album, 'duration': audio.info.length, 'cover': cover}
+
+
+def first_tag_value(tags, key):
+    values = tags.get(key) if tags is not None else None
+    # ID3 frames keep their values in the text attribute
+    values = getattr(values, 'text', values)
+    return str(values[0]) if values else None
+
+
+# On-disk cache of display-sized album covers keyed by file path, size and modification time.
+# Least recently used covers are removed when the cache grows over its size limit
+class CoverCache:
+    def __init__(self, cache_dir, max_size=None, cover_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size or COVER_CACHE_MAX_SIZE
+        # Largest side of the cached covers
+        self.cover_size = cover_size or DEFAULT_COVER_SIZE_LIMIT
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, file_path):
+        stat = os.stat(file_path)
+        key_data = f'{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.cover_size}'
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+    # returns (found, image data), image data is None for the files without a cover
+    def get(self, key):
+        for path, data in ((os.path.join(self.cache_dir, key), True),
+                           (os.path.join(self.cache_dir, key + NO_COVER_SUFFIX), None)):
+            try:
+                if data:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                # Update modification time, it's used as the last access time
+                os.utime(path)
+                return True, data
+            except FileNotFoundError:
+                pass
+        return False, None
+
+    # stores a display-sized copy of the cover and returns its image data
+    def put(self, key, data):
+        image = decode_image(data, self.cover_size) if data else QImage()
+        if image.isNull():
+            # Remember that the file doesn't have a (readable) cover
+            open(os.path.join(self.cache_dir, key + NO_COVER_SUFFIX), 'wb').close()
+            return None
+
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        image.save(buffer, 'PNG' if image.hasAlphaChannel() else 'JPG', 90)
+        data = bytes(buffer.data())
+
+        # Written to a temporary file first, so that readers never see a half-written cover
+        path = os.path.join(self.cache_dir, key)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        self.evict()
+        return data
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size = sum(size for _, size, _ in entries)
+            if total_size <= self.max_size:
+                return
+            # Remove the least recently used covers until the cache takes 90% of its limit
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+                if total_size <= self.max_size * 0.9:
+                    break
+
+
+# Reads album covers on worker threads, so that slow disks don't freeze the window
+class CoverLoader(QObject):
+    # request id, image data (None if there is no cover)
+    cover_loaded = pyqtSignal(int, object)
+
+    def __init__(self):
+        super().__init__()
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(COVER_LOADER_THREADS)
+        # Set once the app data dir is known
+        self.cover_cache = None
+
+    def load(self, request_id, file_path):
+        self.thread_pool.start(CoverTask(self, request_id, file_path))
+
+
+class CoverTask(QRunnable):
+    def __init__(self, loader, request_id, file_path):
+        super().__init__()
+        self.loader = loader
+        self.request_id = request_id
+        self.file_path = file_path
+
+    def run(self):
+        try:
+            cover_cache = self.loader.cover_cache
+            if cover_cache:
+                # Known files don't need their tags to be parsed at all
+                key = cover_cache.key(self.file_path)
+                found, data = cover_cache.get(key)
+                if not found:
+                    # Raw tag data is dropped as soon as the display-sized copy is made
+                    data = cover_cache.put(key, read_album_cover(self.file_path))
+            else:
+                data = read_album_cover(self.file_path)
+        except Exception as e:
+            print("Failed to read album cover:", self.file_path, e)
+            data = None
+        # Signal is delivered to the GUI thread
+        self.loader.cover_loaded.emit(self.request_id, data)
+
+
+# Fast content fingerprint: file size and a hash of a few chunks at fixed offsets, so that resume positions
+# survive moving and renaming of files without reading them as a whole
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return cached_file_fingerprint(file_path, stat.st_size, stat.st_mtime_ns)
+
+
+# Memoized per path, size and modification time
+@functools.lru_cache(maxsize=4096)
+def cached_file_fingerprint(file_path, size, mtime):
+    chunk_size = FINGERPRINT_CHUNK_SIZE
+    offsets = sorted({0, size // 4, size // 2, size * 3 // 4, max(0, size - chunk_size)})
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for offset in offsets:
+            if hasattr(os, 'pread'):
+                file_hash.update(os.pread(f.fileno(), chunk_size, offset))
+            else:
+                f.seek(offset)
+                file_hash.update(f.read(chunk_size))
+    return f'{size}-{file_hash.hexdigest()}'
+
+
+# Resume positions kept in an SQLite database (WAL mode): point lookups and single-row upserts by file path,
+# the oldest positions are evicted through the index on timestamp.
+# Several player windows may share the database, a position is only replaced by a newer one.
+# Positions can also be found by content fingerprint, if a file was moved or renamed
+class PlaybackStore:
+    def __init__(self, db_file, json_file=None, max_positions=None):
+        self.max_positions = max_positions or MAX_PLAYBACK_POSITIONS
+        self.lock = threading.Lock()
+        # Autocommit mode, every statement is a transaction of its own
+        self.connection = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS playback_positions ('
+                                'file_path TEXT PRIMARY KEY, position INTEGER NOT NULL, timestamp TEXT NOT NULL, '
+                                'fingerprint TEXT)')
+        # Databases created before fingerprints were added
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(playback_positions)')]
+        if 'fingerprint' not in columns:
+            self.connection.execute('ALTER TABLE playback_positions ADD COLUMN fingerprint TEXT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS playback_positions_timestamp '
+                                'ON playback_positions (timestamp)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS playback_positions_fingerprint '
+                                'ON playback_positions (fingerprint)')
+        if json_file and os.path.exists(json_file):
+            self.migrate(json_file)
+        self.count = self.connection.execute('SELECT COUNT(*) FROM playback_positions').fetchone()[0]
+        # Positions are read on the GUI thread through a connection of its own: in WAL mode readers don't wait
+        # for writers, so a save waiting for another instance's write lock can't freeze the window
+        self.read_connection = sqlite3.connect(f'{pathlib.Path(db_file).absolute().as_uri()}?mode=ro', uri=True,
+                                               timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+
+    # imports positions from the old json file and keeps the file as a backup
+    def migrate(self, json_file):
+        try:
+            with open(json_file, 'r') as f:
+                positions = json.load(f)
+            with self.lock, self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO playback_positions (file_path, position, timestamp) VALUES (?, ?, ?)',
+                    [(file_path, int(entry['position']), entry['timestamp'])
+                     for file_path, entry in positions.items()])
+            os.replace(json_file, json_file + '.migrated')
+        except FileNotFoundError:
+            pass  # migrated by another instance started at the same time
+
+    # called on the GUI thread only
+    def get(self, file_path):
+        row = self.read_connection.execute('SELECT position, timestamp FROM playback_positions WHERE file_path = ?',
+                                           (file_path,)).fetchone()
+        if row is None:
+            return None
+        return {'position': row[0], 'timestamp': row[1]}
+
+    # latest position saved for a file with the same content under any path
+    def get_by_fingerprint(self, fingerprint):
+        with self.lock:
+            row = self.connection.execute('SELECT position, timestamp FROM playback_positions WHERE fingerprint = ? '
+                                          'ORDER BY timestamp DESC LIMIT 1', (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        return {'position': row[0], 'timestamp': row[1]}
+
+    def save(self, file_path, position, timestamp, fingerprint=None):
+        with self.lock, self.connection:
+            # Write lock is taken at once, so other instances can't change the row between the statements
+            self.connection.execute('BEGIN IMMEDIATE')
+            is_new = self.connection.execute('SELECT 1 FROM playback_positions WHERE file_path = ?',
+                                             (file_path,)).fetchone() is None
+            # Position saved by another instance later than this one is kept
+            self.connection.execute(
+                'INSERT INTO playback_positions (file_path, position, timestamp, fingerprint) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (file_path) DO UPDATE SET position = excluded.position, timestamp = excluded.timestamp, '
+                'fingerprint = excluded.fingerprint WHERE excluded.timestamp >= playback_positions.timestamp',
+                (file_path, position, timestamp, fingerprint))
+            if is_new:
+                self.count += 1
+            if self.count > self.max_positions:
+                self.evict()
+
+    def evict(self):
+        # Other instances add positions too, so the count is only exact after it's recounted
+        self.count = self.connection.execute('SELECT COUNT(*) FROM playback_positions').fetchone()[0]
+        if self.count > self.max_positions:
+            # Removes the oldest positions using the index on timestamp
+            self.connection.execute('DELETE FROM playback_positions WHERE file_path IN ('
+                                    'SELECT file_path FROM playback_positions ORDER BY timestamp LIMIT ?)',
+                                    (self.count - self.max_positions,))
+            self.count = self.max_positions
+
+    def close(self):
+        self.read_connection.close()
+        with self.lock:
+            self.connection.close()
+
+
+# Saves resume positions on a background thread at most once per CHECKPOINT_INTERVAL,
+# so that a crash loses only the last few seconds of playback and the GUI thread never waits for the disk.
+# Fingerprints of the files are computed on the same thread, when positions are written or looked up
+class PlaybackCheckpointer(QObject):
+    # file path, position saved for a file with the same content (None if there is none)
+    fingerprint_lookup_finished = pyqtSignal(str, object)
+
+    def __init__(self, playback_store, interval=None):
+        super().__init__()
+        self.playback_store = playback_store
+        self.interval = interval or CHECKPOINT_INTERVAL
+        # Latest position which is not written yet: (file_path, position, timestamp)
+        self.pending = None
+        self.last_write = 0
+        # Positions saved during this session, they may still be on their way to the database
+        self.recent_positions = {}
+        # Single thread, so that positions are written in the order they were saved
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.timeout.connect(self.flush)
+
+    def checkpoint(self, file_path, position):
+        # Position of another file must not be replaced by this one before it's written
+        if self.pending and self.pending[0] != file_path:
+            self.flush()
+
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.pending = (file_path, position, timestamp)
+        self.recent_positions[file_path] = {'position': position, 'timestamp': timestamp}
+
+        if not self.debounce_timer.isActive():
+            delay = max(0.0, self.last_write + self.interval - time.monotonic())
+            self.debounce_timer.start(int(delay * 1000))
+
+    def flush(self):
+        self.debounce_timer.stop()
+        if self.pending:
+            self.executor.submit(self.save, *self.pending)
+            self.pending = None
+            self.last_write = time.monotonic()
+
+    # runs on the background thread
+    def save(self, file_path, position, timestamp):
+        try:
+            fingerprint = file_fingerprint(file_path)
+        except OSError:
+            fingerprint = None
+        self.playback_store.save(file_path, position, timestamp, fingerprint)
+
+    def get(self, file_path):
+        recent_position = self.recent_positions.get(file_path)
+        saved_position = self.playback_store.get(file_path)
+        # The file may have been played in another instance after this one
+        if recent_position and (saved_position is None or recent_position['timestamp'] >= saved_position['timestamp']):
+            return recent_position
+        return saved_position
+
+    # looks for the position of a moved or renamed file in the background, the result is sent with
+    # fingerprint_lookup_finished
+    def find_by_fingerprint(self, file_path):
+        self.executor.submit(self.lookup_fingerprint, file_path)
+
+    # runs on the background thread
+    def lookup_fingerprint(self, file_path):
+        try:
+            position = self.playback_store.get_by_fingerprint(file_fingerprint(file_path))
+        except OSError:
+            position = None
+        # Signal is delivered to the GUI thread
+        self.fingerprint_lookup_finished.emit(file_path, position)
+
+    # writes the last position and waits until everything is saved
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
+# Tags of the media files under the library roots in an SQLite database (WAL mode), indexed for browsing
+# by artist and album. Size and modification time of every file are kept, so rescans only read changed files
+class LibraryIndex:
+    def __init__(self, db_file):
+        self.lock = threading.Lock()
+        # Autocommit mode, every statement is a transaction of its own
+        self.connection = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS library ('
+                                'file_path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+                                'title TEXT, artist TEXT, album TEXT, duration REAL, cover_hash TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS library_artist_album '
+                                'ON library (artist, album, file_path)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS library_album ON library (album)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS library_title ON library (title)')
+
+    # file path -> (size, modification time) of the indexed files under the root
+    def file_states(self, root):
+        # Range of the primary key instead of LIKE, so that the index is used
+        prefix = os.path.join(root, '')
+        with self.lock:
+            rows = self.connection.execute('SELECT file_path, size, mtime FROM library '
+                                           'WHERE file_path >= ? AND file_path < ?',
+                                           (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).fetchall()
+        return {file_path: (size, mtime) for file_path, size, mtime in rows}
+
+    # entries are (file_path, size, mtime, title, artist, album, duration, cover_hash), applied in one transaction
+    def update(self, entries, removed_paths=()):
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany(
+                'INSERT INTO library (file_path, size, mtime, title, artist, album, duration, cover_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (file_path) DO UPDATE SET size = excluded.size, '
+                'mtime = excluded.mtime, title = excluded.title, artist = excluded.artist, album = excluded.album, '
+                'duration = excluded.duration, cover_hash = excluded.cover_hash', entries)
+            self.connection.executemany('DELETE FROM library WHERE file_path = ?',
+                                        [(file_path,) for file_path in removed_paths])
+
+    # paths of all files, by artist and album
+    def files(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT file_path FROM library ORDER BY artist, album, file_path')
+            return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Reads tags of a library file and returns its entry for the index. Runs on the worker threads
+def read_library_entry(file_path, size, mtime):
+    title = artist = album = duration = cover_hash = None
+    try:
+        tags = read_media_tags(file_path)
+        if tags:
+            title, artist, album, duration = tags['title'], tags['artist'], tags['album'], tags['duration']
+            if tags['cover']:
+                cover_hash = hashlib.blake2b(tags['cover'], digest_size=16).hexdigest()
+    except Exception as e:
+        print("Failed to read tags:", file_path, e)
+    return file_path, size, mtime, title, artist, album, duration, cover_hash
+
+
+# Edits which turn the old list of the library files into the new one: [row, number of removed files, inserted files],
+# applied in order. Files keep their order unless they were added, removed or changed (new tags may move them),
+# so one pass over both lists finds the rows which differ
+def library_edits(old_files, new_files, changed):
+    old_set = set(old_files)
+    new_set = set(new_files)
+    # Moved files: inserted before they are reached in the old list, or removed before they are reached in the new one
+    inserted_early = set()
+    removed_early = set()
+    edits = []
+    row = i = j = 0
+    while i < len(old_files) or j < len(new_files):
+        old_file = old_files[i] if i < len(old_files) else None
+        new_file = new_files[j] if j < len(new_files) else None
+        if old_file == new_file:
+            row += 1
+            i += 1
+            j += 1
+            continue
+        if old_file is not None and (old_file not in new_set or old_file in inserted_early):
+            remove = True
+        elif new_file is not None and (new_file not in old_set or new_file in removed_early):
+            remove = False
+        elif new_file is not None and (new_file in changed or old_file not in changed):
+            inserted_early.add(new_file)
+            remove = False
+        else:
+            removed_early.add(old_file)
+            remove = True
+
+        # Removed and inserted files next to each other are one edit
+        if edits and edits[-1][0] + len(edits[-1][2]) == row:
+            edit = edits[-1]
+        else:
+            edit = [row, 0, []]
+            edits.append(edit)
+        if remove:
+            edit[1] += 1
+            i += 1
+        else:
+            edit[2].append(new_file)
+            row += 1
+            j += 1
+    return edits
+
+
+# Walks the library roots and updates the index in the background. Directories are listed and tags are read
+# by a thread pool, only new files and files with another size or modification time are read.
+# Changes found by the library watcher are applied the same way, for the changed paths only
+class LibraryScanner(QObject):
+    # files found, added or changed files, removed files, seconds
+    scan_finished = pyqtSignal(int, int, int, float)
+    # version, paths of all indexed files
+    library_listed = pyqtSignal(int, list)
+    # version, edits of the previous version (see library_edits)
+    library_changed = pyqtSignal(int, list)
+
+    def __init__(self, library_index, roots):
+        super().__init__()
+        self.library_index = library_index
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=LIBRARY_SCAN_THREADS)
+        # Scans are run one at a time
+        self.scan_executor = ThreadPoolExecutor(max_workers=1)
+        # Library is listed for the playlist panel without waiting for a running scan
+        self.list_executor = ThreadPoolExecutor(max_workers=1)
+        # Last listed files, the edits of the following updates are computed against them
+        self.library_lock = threading.Lock()
+        self.library_files = None
+        self.library_version = 0
+
+    def scan(self):
+        self.scan_executor.submit(self.run)
+
+    # changes: path -> True if the whole directory tree has to be updated, False for a file or for the files
+    # of a directory without its subdirectories
+    def update_paths(self, changes):
+        self.scan_executor.submit(self.apply_changes, changes)
+
+    # lists the indexed files in the background, they are sent with library_listed. Once listed, the changes
+    # of the following scans and updates are sent as edits with library_changed
+    def list_files(self):
+        self.list_executor.submit(self.list_library)
+
+    # runs on the background thread
+    def list_library(self):
+        with self.library_lock:
+            self.library_files = self.library_index.files()
+            self.library_version += 1
+            # Receiver edits its own copy
+            self.library_listed.emit(self.library_version, list(self.library_files))
+
+    # runs on the background thread
+    def update_library_files(self, changed):
+        with self.library_lock:
+            if self.library_files is None:
+                return
+            files = self.library_index.files()
+            edits = library_edits(self.library_files, files, changed)
+            self.library_files = files
+            if edits:
+                self.library_version += 1
+                self.library_changed.emit(self.library_version, edits)
+
+    # runs on the background thread
+    def run(self):
+        roots = {}
+        for root in self.roots:
+            if os.path.isdir(root):
+                roots[root] = True
+            else:
+                # Unavailable share or disk, its files are kept in the index
+                print("Library root not found:", root)
+        self.apply_changes(roots)
+
+    # runs on the background thread
+    def apply_changes(self, changes):
+        start = time.perf_counter()
+        # Found files and the indexed files of the same paths: file path -> (size, modification time)
+        files = {}
+        known_files = {}
+        removed = []
+        for path, recursive in changes.items():
+            if os.path.isdir(path):
+                dir_known_files = self.library_index.file_states(path)
+                if recursive:
+                    dir_files, failed_dirs = self.walk(path)
+                else:
+                    _, dir_files, _, ok = self.scan_dir(path)
+                    failed_dirs = [] if ok else [path]
+                    dir_known_files = {file_path: state for file_path, state in dir_known_files.items()
+                                       if os.path.dirname(file_path) == path}
+                # Files of the directories which couldn't be listed are not removed
+                failed_prefixes = tuple(os.path.join(failed_dir, '') for failed_dir in failed_dirs)
+                removed += [file_path for file_path in dir_known_files
+                            if file_path not in dir_files and not file_path.startswith(failed_prefixes)]
+                files.update(dir_files)
+                known_files.update(dir_known_files)
+            elif os.path.isfile(path):
+                if path.lower().endswith(MEDIA_EXTENSIONS):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime_ns)
+            else:
+                # Removed file or directory
+                removed += list(self.library_index.file_states(path))
+                if path.lower().endswith(MEDIA_EXTENSIONS):
+                    removed.append(path)
+        # Listing was interrupted, the files which weren't listed must not be removed
+        if self.closed:
+            return
+        changed = [file_path for file_path, state in files.items() if known_files.get(file_path) != state]
+
+        # Small updates are written in one transaction together with the removed files
+        for batch_start in range(0, len(changed), LIBRARY_BATCH_SIZE):
+            if self.closed:
+                return
+            batch = changed[batch_start:batch_start + LIBRARY_BATCH_SIZE]
+            entries = list(self.executor.map(read_library_entry, batch, *zip(*(files[path] for path in batch))))
+            self.library_index.update(entries, removed if batch_start + LIBRARY_BATCH_SIZE >= len(changed) else ())
+        if not changed:
+            self.library_index.update([], removed)
+        if changed or removed:
+            self.update_library_files(set(changed))
+        self.scan_finished.emit(len(files), len(changed), len(removed), time.perf_counter() - start)
+
+    # returns file path -> (size, modification time) of the media files and the directories which failed.
+    # The listing is incomplete if the scanner is closed meanwhile
+    def walk(self, root):
+        files = {}
+        failed_dirs = []
+        pending = {self.executor.submit(self.scan_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, dir_files, subdirs, ok = future.result()
+                files.update(dir_files)
+                if not ok:
+                    failed_dirs.append(path)
+                if not self.closed:
+                    pending |= {self.executor.submit(self.scan_dir, subdir) for subdir in subdirs}
+        return files, failed_dirs
+
+    # runs on the worker threads
+    def scan_dir(self, path):
+        files = {}
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(MEDIA_EXTENSIONS):
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        # Broken symbolic link or a file removed meanwhile, the rest of the directory is listed
+                        continue
+        except OSError as e:
+            print("Failed to scan:", path, e)
+            return path, files, subdirs, False
+        return path, files, subdirs, True
+
+    def close(self):
+        self.closed = True
+        self.list_executor.shutdown(wait=True)
+        self.scan_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+
+
+# Watches the library roots for created, modified, moved and deleted files, with inotify on Linux and with the
+# directory change notifications of the OS (QFileSystemWatcher) elsewhere. Directories which can't be watched are
+# polled as a last resort. Changes are collected for LIBRARY_UPDATE_DELAY after the last one (at most
+# LIBRARY_UPDATE_MAX_DELAY), so that a copied album is indexed in one update
+class LibraryWatcher(QObject):
+    # path, True if the whole directory tree has changed
+    path_changed = pyqtSignal(str, bool)
+    # directories listed in the background, to be watched
+    dirs_found = pyqtSignal(list)
+    # changed directory, paths of its subdirectories (None if it was removed)
+    dir_checked = pyqtSignal(str, object)
+
+    def __init__(self, library_scanner, roots):
+        super().__init__()
+        self.library_scanner = library_scanner
+        self.roots = [os.path.abspath(root) for root in roots if os.path.isdir(root)]
+        self.closed = False
+        # path -> recursive, waiting for the update
+        self.changes = {}
+        self.first_change_time = 0
+        self.path_changed.connect(self.on_path_changed)
+        self.dirs_found.connect(self.watch_dirs)
+        self.dir_checked.connect(self.on_dir_checked)
+
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.timeout.connect(self.flush)
+
+        # Used instead of inotify: watched or polled directory -> its subdirectories
+        self.fs_watcher = None
+        self.dirs = {}
+        # Changed directories which are waiting to be listed
+        self.pending_dirs = set()
+        # Directories are listed on a background thread, one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Inotify or polling thread, the polled directory trees are added while it runs
+        self.thread = None
+        self.lock = threading.Lock()
+        self.polled_roots = []
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if sys.platform.startswith('linux'):
+            self.thread = threading.Thread(target=self.run, name='LibraryWatcher', daemon=True)
+            self.thread.start()
+        else:
+            self.fs_watcher = QFileSystemWatcher(self)
+            self.fs_watcher.directoryChanged.connect(self.on_directory_changed)
+            for root in self.roots:
+                self.executor.submit(self.list_tree, root)
+
+    # runs on the watcher thread
+    def run(self):
+        try:
+            self.watch_inotify()
+        except OSError as e:
+            # Too many directories for the inotify watch limit
+            print("Failed to watch the library with inotify, polling:", e)
+            with self.lock:
+                self.polled_roots += self.roots
+            self.watch_polling()
+
+    # runs on the background thread, the directories are watched on the GUI thread in batches
+    def list_tree(self, path):
+        batch = []
+        for dir_path, _, _ in os.walk(path):
+            if self.closed:
+                return
+            batch.append(dir_path)
+            if len(batch) == LIBRARY_WATCH_BATCH_SIZE:
+                self.dirs_found.emit(batch)
+                batch = []
+        if batch:
+            self.dirs_found.emit(batch)
+
+    def watch_dirs(self, dir_paths):
+        dir_paths = [dir_path for dir_path in dir_paths if dir_path not in self.dirs]
+        if self.closed or not dir_paths:
+            return
+        failed = set(self.fs_watcher.addPaths(dir_paths))
+        polled_prefixes = tuple(os.path.join(root, '') for root in self.polled_roots)
+        for dir_path in dir_paths:
+            self.dirs[dir_path] = set()
+            parent_subdirs = self.dirs.get(os.path.dirname(dir_path))
+            if parent_subdirs is not None:
+                parent_subdirs.add(dir_path)
+            if dir_path in failed and not dir_path.startswith(polled_prefixes):
+                # E.g. a network share without change notifications, its whole tree is polled
+                print("Failed to watch library directory, polling:", dir_path)
+                self.poll_tree(dir_path)
+                polled_prefixes += (os.path.join(dir_path, ''),)
+
+    def poll_tree(self, path):
+        with self.lock:
+            self.polled_roots.append(path)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.watch_polling, name='LibraryWatcher', daemon=True)
+            self.thread.start()
+
+    # a file or a subdirectory of the watched directory was created, renamed or deleted
+    def on_directory_changed(self, path):
+        # Burst of changes is listed once
+        if path not in self.pending_dirs:
+            self.pending_dirs.add(path)
+            self.executor.submit(self.check_dir, path)
+
+    # runs on the background thread
+    def check_dir(self, path):
+        self.pending_dirs.discard(path)
+        subdirs = set()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.add(entry.path)
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            subdirs = None
+        except OSError as e:
+            print("Failed to list library directory:", path, e)
+            return
+        self.dir_checked.emit(path, subdirs)
+
+    def on_dir_checked(self, path, subdirs):
+        if self.closed or path not in self.dirs:
+            return
+        if subdirs is None:
+            # Removed or moved away together with its subdirectories
+            self.unwatch_tree(path)
+            self.on_path_changed(path, True)
+            return
+        self.on_path_changed(path, False)
+        known_subdirs = self.dirs[path]
+        for subdir in known_subdirs - subdirs:
+            self.unwatch_tree(subdir)
+            self.on_path_changed(subdir, True)
+        for subdir in subdirs - known_subdirs:
+            # Created or moved in directory is indexed as a whole
+            self.on_path_changed(subdir, True)
+            self.executor.submit(self.list_tree, subdir)
+
+    def unwatch_tree(self, path):
+        removed = []
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            removed.append(dir_path)
+            stack += self.dirs.pop(dir_path, ())
+        self.dirs.get(os.path.dirname(path), set()).discard(path)
+        self.fs_watcher.removePaths(removed)
+
+    # runs on the watcher thread
+    def watch_inotify(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory
+        watches = {}
+
+        def add_tree(path):
+            for dir_path, dir_names, _ in os.walk(path):
+                wd = libc.inotify_add_watch(fd, os.fsencode(dir_path), INOTIFY_MASK)
+                if wd < 0:
+                    error = ctypes.get_errno()
+                    if error == errno.ENOSPC:
+                        raise OSError(error, 'inotify watch limit reached')
+                    continue
+                watches[wd] = dir_path
+
+        try:
+            for root in self.roots:
+                add_tree(root)
+            while not self.closed:
+                # Timeout lets the thread notice that the watcher is closed
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                data = os.read(fd, 64 * 1024)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+                    name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+                    offset += 16 + length
+
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were lost, the roots are checked as a whole
+                        for root in self.roots:
+                            self.path_changed.emit(root, True)
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    dir_path = watches.get(wd)
+                    if dir_path is None or not name:
+                        continue
+                    path = os.path.join(dir_path, name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            add_tree(path)
+                        elif mask & IN_MOVED_FROM:
+                            # Moved directory keeps its watches, they would report the old paths
+                            prefix = os.path.join(path, '')
+                            for moved_wd in [wd for wd, watched in watches.items()
+                                             if watched == path or watched.startswith(prefix)]:
+                                libc.inotify_rm_watch(fd, moved_wd)
+                                watches.pop(moved_wd)
+                        self.path_changed.emit(path, True)
+                    elif not mask & IN_CREATE and path.lower().endswith(MEDIA_EXTENSIONS):
+                        self.path_changed.emit(path, False)
+        finally:
+            os.close(fd)
+
+    # runs on the watcher thread. Modification times of the directories are checked every LIBRARY_POLL_INTERVAL,
+    # they change when files are created, moved or deleted. Files modified in place (e.g. their tags) are found
+    # by comparing sizes and modification times of the media files every LIBRARY_FILE_POLL_INTERVAL
+    def watch_polling(self):
+        # directory -> modification time, directory -> {media file -> (size, modification time)}
+        dirs = {}
+        dir_files = {}
+        polled_count = 0
+
+        def list_files(dir_path):
+            files = {}
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.name.lower().endswith(MEDIA_EXTENSIONS) and entry.is_file():
+                                # Windows reads the stat of the entry with the directory listing
+                                stat = entry.stat()
+                                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+            return files
+
+        def add_tree(path):
+            for dir_path, _, _ in os.walk(path):
+                try:
+                    dirs[dir_path] = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    continue
+                dir_files[dir_path] = list_files(dir_path)
+
+        last_file_check = time.monotonic()
+        while not self.closed:
+            with self.lock:
+                new_roots = self.polled_roots[polled_count:]
+            polled_count += len(new_roots)
+            for root in new_roots:
+                add_tree(root)
+            if self.stop_event.wait(LIBRARY_POLL_INTERVAL):
+                return
+            check_files = time.monotonic() - last_file_check >= LIBRARY_FILE_POLL_INTERVAL
+            if check_files:
+                last_file_check = time.monotonic()
+            for dir_path, mtime in list(dirs.items()):
+                if self.closed:
+                    return
+                try:
+                    new_mtime = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    # Removed or moved away together with its subdirectories
+                    for removed_dir in [path for path in dirs
+                                        if path == dir_path or path.startswith(os.path.join(dir_path, ''))]:
+                        del dirs[removed_dir]
+                        dir_files.pop(removed_dir, None)
+                    self.path_changed.emit(dir_path, True)
+                    continue
+                if new_mtime == mtime:
+                    if check_files:
+                        files = list_files(dir_path)
+                        for file_path, state in files.items():
+                            if dir_files.get(dir_path, {}).get(file_path) != state:
+                                self.path_changed.emit(file_path, False)
+                        dir_files[dir_path] = files
+                    continue
+                dirs[dir_path] = new_mtime
+                dir_files[dir_path] = list_files(dir_path)
+                self.path_changed.emit(dir_path, False)
+                # New subdirectories are indexed as a whole
+                try:
+                    with os.scandir(dir_path) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False) and entry.path not in dirs:
+                                add_tree(entry.path)
+                                self.path_changed.emit(entry.path, True)
+                except OSError:
+                    pass
+
+    def on_path_changed(self, path, recursive):
+        if not self.changes:
+            self.first_change_time = time.monotonic()
+        self.changes[path] = self.changes.get(path, False) or recursive
+        # Waits for the burst to end, but not longer than LIBRARY_UPDATE_MAX_DELAY
+        waited = int((time.monotonic() - self.first_change_time) * 1000)
+        self.update_timer.start(max(0, min(LIBRARY_UPDATE_DELAY, LIBRARY_UPDATE_MAX_DELAY - waited)))
+
+    def flush(self):
+        changes, self.changes = self.changes, {}
+        # Paths inside of the changed directory trees are updated with them
+        trees = tuple(os.path.join(path, '') for path, recursive in changes.items() if recursive)
+        changes = {path: recursive for path, recursive in changes.items() if not path.startswith(trees)}
+        if changes:
+            self.library_scanner.update_paths(changes)
+
+    def close(self):
+        self.closed = True
+        self.stop_event.set()
+        self.update_timer.stop()
+        self.executor.shutdown(wait=True)
+        if self.thread:
+            self.thread.join()
+
+
+# Name of the local socket (named pipe on Windows) of the running player, one per user
+def instance_server_name():
+    return f'{INSTANCE_SERVER_NAME}-{getpass.getuser()}'
+
+
+# Sends the file path to an already running player, returns False if there is none
+def forward_to_running_instance(file_path):
+    socket = QLocalSocket()
+    socket.connectToServer(instance_server_name())
+    if not socket.waitForConnected(INSTANCE_CONNECT_TIMEOUT):
+        return False
+    # Empty message only brings the running player to front
+    socket.write(os.path.abspath(file_path).encode('utf-8') if file_path else b'')
+    socket.waitForBytesWritten(INSTANCE_CONNECT_TIMEOUT)
+    socket.disconnectFromServer()
+    if socket.state() != QLocalSocket.UnconnectedState:
+        socket.waitForDisconnected(INSTANCE_CONNECT_TIMEOUT)
+    return True
+
+
+# Receives file paths from the player instances started after this one
+class InstanceServer(QObject):
+    # file path ('' if no file was passed)
+    file_received = pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self):
+        if self.server.listen(instance_server_name()):
+            return True
+        # Socket file left by a crashed player (Unix)
+        QLocalServer.removeServer(instance_server_name())
+        return self.server.listen(instance_server_name())
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            socket.setProperty('message', b'')
+            socket.readyRead.connect(lambda socket=socket: self.read_message(socket))
+            socket.disconnected.connect(lambda socket=socket: self.on_disconnected(socket))
+
+    def read_message(self, socket):
+        socket.setProperty('message', socket.property('message') + bytes(socket.readAll()))
+
+    # the whole message is received when the sender disconnects
+    def on_disconnected(self, socket):
+        self.read_message(socket)
+        self.file_received.emit(socket.property('message').decode('utf-8'))
+        socket.deleteLater()
+
+
+# Media files of the given folders, playlists and files, in the given order
+def expand_media_paths(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name) for name in sorted(os.listdir(path), key=str.lower)
+                      if name.lower().endswith(MEDIA_EXTENSIONS) and os.path.isfile(os.path.join(path, name))]
+        elif path.lower().endswith(PLAYLIST_EXTENSIONS):
+            files += read_m3u(path)
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+# Entries of an M3U playlist, relative paths are resolved against the folder of the playlist
+def read_m3u(playlist_path):
+    with open(playlist_path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # Plain .m3u files are often saved in a legacy encoding
+        text = data.decode('latin-1')
+
+    playlist_dir = os.path.dirname(os.path.abspath(playlist_path))
+    files = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('file://'):
+            line = QUrl(line).toLocalFile()
+        elif '://' in line:
+            # Streams are not supported
+            continue
+        files.append(os.path.normpath(os.path.join(playlist_dir, line)))
+    return files
+
+
+# Files which are played one after another
+class PlaybackQueue:
+    def __init__(self):
+        self.files = []
+        self.index = -1
+
+    # index of the current file, -1 - the first file is the next one
+    def set_files(self, files, index=0):
+        self.files = list(files)
+        self.index = index if self.files else -1
+
+    def current(self):
+        return self.files[self.index] if 0 <= self.index < len(self.files) else None
+
+    def peek_next(self):
+        return self.files[self.index + 1] if self.index + 1 < len(self.files) else None
+
+    def next(self):
+        if self.index + 1 >= len(self.files):
+            return None
+        self.index += 1
+        return self.files[self.index]
+
+    def previous(self):
+        if self.index <= 0:
+            return None
+        self.index -= 1
+        return self.files[self.index]
+
+    def select(self, index):
+        if not 0 <= index < len(self.files):
+            return None
+        self.index = index
+        return self.files[index]
+
+    # edits of the shown library (see library_edits), the current file stays the current one
+    def apply_edits(self, edits):
+        current = self.current()
+        for row, removed, inserted in edits:
+            self.files[row:row + removed] = inserted
+            if current is not None and current in inserted:
+                # Current file has moved
+                self.index = row + inserted.index(current)
+            elif self.index >= row + removed:
+                self.index += len(inserted) - removed
+            elif self.index >= row:
+                # Current file was removed, the file at its place is the next one
+                self.index = row - 1
+
+
+# Rows of the playlist panel. Rows are added in pages as the view scrolls to them, title, duration and cover
+# thumbnail are read in the background for the visible rows only and kept for a limited number of rows
+class PlaylistModel(QAbstractListModel):
+    # generation, row, (title, duration, thumbnail QImage or None)
+    metadata_loaded = pyqtSignal(int, int, object)
+
+    def __init__(self):
+        super().__init__()
+        self.files = []
+        # Rows shown to the view so far
+        self.shown_rows = 0
+        # Results of the previous files are ignored
+        self.generation = 0
+        # Row -> [title, duration, thumbnail], least recently used rows are removed first
+        self.metadata = OrderedDict()
+        self.pending_rows = set()
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(PLAYLIST_LOADER_THREADS)
+        self.metadata_loaded.connect(self.on_metadata_loaded)
+
+    def set_files(self, files):
+        self.beginResetModel()
+        self.files = list(files)
+        self.shown_rows = min(len(files), PLAYLIST_PAGE_SIZE)
+        self.generation += 1
+        self.metadata.clear()
+        self.pending_rows.clear()
+        self.thread_pool.clear()
+        self.endResetModel()
+
+    # edits of the shown library (see library_edits), rows are removed and inserted without a reset, so the view
+    # keeps its scroll position and selection
+    def apply_edits(self, edits):
+        for row, removed, inserted in edits:
+            if removed:
+                # Rows after the shown ones are not known to the view
+                last = min(row + removed, self.shown_rows) - 1
+                if row <= last:
+                    self.beginRemoveRows(QModelIndex(), row, last)
+                del self.files[row:row + removed]
+                self.shift_metadata(row, removed, 0)
+                if row <= last:
+                    self.shown_rows -= last - row + 1
+                    self.endRemoveRows()
+            if inserted:
+                shown = row < self.shown_rows or self.shown_rows == len(self.files)
+                if shown:
+                    self.beginInsertRows(QModelIndex(), row, row + len(inserted) - 1)
+                self.files[row:row] = inserted
+                self.shift_metadata(row, 0, len(inserted))
+                if shown:
+                    self.shown_rows += len(inserted)
+                    self.endInsertRows()
+        # Rows of the pending reads have changed
+        self.generation += 1
+        self.pending_rows.clear()
+        self.thread_pool.clear()
+
+    # metadata of the removed rows is dropped, the rows after them are moved
+    def shift_metadata(self, row, removed, inserted):
+        metadata = OrderedDict()
+        for metadata_row, row_metadata in self.metadata.items():
+            if metadata_row < row:
+                metadata[metadata_row] = row_metadata
+            elif metadata_row >= row + removed:
+                metadata[metadata_row - removed + inserted] = row_metadata
+        self.metadata = metadata
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.shown_rows
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.shown_rows < len(self.files)
+
+    def fetchMore(self, parent):
+        self.show_rows(self.shown_rows + PLAYLIST_PAGE_SIZE)
+
+    def show_rows(self, rows):
+        rows = min(rows, len(self.files))
+        if rows > self.shown_rows:
+            self.beginInsertRows(QModelIndex(), self.shown_rows, rows - 1)
+            self.shown_rows = rows
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        metadata = self.metadata.get(row)
+        if metadata is not None:
+            self.metadata.move_to_end(row)
+        if role == Qt.DisplayRole:
+            if metadata is None:
+                return os.path.basename(self.files[row])
+            title, duration = metadata[0], metadata[1]
+            return f'{title}  ({self.format_duration(duration)})' if duration else title
+        if role == Qt.DecorationRole and metadata is not None and metadata[2] is not None:
+            if isinstance(metadata[2], QImage):
+                # Pixmaps can only be made in the GUI thread
+                metadata[2] = QPixmap.fromImage(metadata[2])
+            return metadata[2]
+        if role == Qt.ToolTipRole:
+            return self.files[row]
+        return None
+
+    def format_duration(self, seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+    # reads metadata of the rows first - last, rows which were scrolled away are not read anymore
+    def load_metadata(self, first, last):
+        self.thread_pool.clear()
+        self.pending_rows.clear()
+        for row in range(max(0, first), min(last, self.shown_rows - 1) + 1):
+            if row not in self.metadata and row not in self.pending_rows:
+                self.pending_rows.add(row)
+                self.thread_pool.start(PlaylistMetadataTask(self, self.generation, row, self.files[row]))
+
+    def on_metadata_loaded(self, generation, row, metadata):
+        if generation != self.generation:
+            return
+        self.pending_rows.discard(row)
+        self.metadata[row] = list(metadata)
+        if len(self.metadata) > PLAYLIST_METADATA_CACHE_SIZE:
+            del self.metadata[next(iter(self.metadata))]
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.DecorationRole])
+
+
+class PlaylistMetadataTask(QRunnable):
+    def __init__(self, model, generation, row, file_path):
+        super().__init__()
+        self.model = model
+        self.generation = generation
+        self.row = row
+        self.file_path = file_path
+
+    def run(self):
+        title, duration, thumbnail = os.path.basename(self.file_path), None, None
+        try:
+            tags = read_media_tags(self.file_path)
+            if tags:
+                title = tags['title'] or title
+                duration = tags['duration']
+                if tags['cover']:
+                    thumbnail = decode_image(tags['cover'], PLAYLIST_THUMBNAIL_SIZE)
+        except Exception as e:
+            print("Failed to read tags:", self.file_path, e)
+        # Signal is delivered to the GUI thread
+        self.model.metadata_loaded.emit(self.generation, self.row, (title, duration, thumbnail))
+
+
+# List of the queued files, shown over the media on the right side of the window
+class PlaylistPanel(QListView):
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        # Rows are never measured one by one, so that long playlists are laid out instantly
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(PLAYLIST_THUMBNAIL_SIZE, PLAYLIST_THUMBNAIL_SIZE))
+        self.setEditTriggers(QListView.NoEditTriggers)
+        self.setStyleSheet("""
+            QListView {
+                background-color: rgba(0, 0, 0, 200);
+                color: white;
+                font-size: 14px;
+            }
+            QListView::item:selected {
+                background-color: #444;
+            }
+        """)
+
+        # Metadata is loaded once scrolling or resizing stops
+        self.load_timer = QTimer(self)
+        self.load_timer.setSingleShot(True)
+        self.load_timer.setInterval(PLAYLIST_LOAD_DELAY)
+        self.load_timer.timeout.connect(self.load_visible_metadata)
+        self.verticalScrollBar().valueChanged.connect(lambda: self.load_timer.start())
+        model.modelReset.connect(lambda: self.load_timer.start())
+        model.rowsInserted.connect(lambda: self.load_timer.start())
+        model.rowsRemoved.connect(lambda: self.load_timer.start())
+
+    def load_visible_metadata(self):
+        if not self.isVisible() or not self.model().rowCount():
+            return
+        first = self.indexAt(QPoint(0, 0)).row()
+        last = self.indexAt(QPoint(0, self.viewport().height() - 1)).row()
+        if first < 0:
+            return
+        self.model().load_metadata(first, last if last >= 0 else self.model().rowCount() - 1)
+
+    # selects and scrolls to the row of the played file
+    def show_row(self, row):
+        self.model().show_rows(row + 1)
+        index = self.model().index(row)
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.load_timer.start()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.load_timer.start()
+
+
+# Reads the played file ahead of the playback position on a background thread, so that the backend finds
+# the data in the OS cache instead of waiting for a network share or a USB disk. The window covers
+# READ_AHEAD_SECONDS of playback at the bitrate of the file. The beginning of the next file is read too
+class ReadAheadPrefetcher(QObject):
+    # generation (-1 for warm-up reads), end offset of the read data, bytes read, seconds
+    chunk_read = pyqtSignal(int, 'qint64', 'qint64', float)
+
+    def __init__(self):
+        super().__init__()
+        self.file_path = None
+        self.size = 0
+        # Reads of an older file or of the range before a seek are abandoned when the generation changes
+        self.generation = 0
+        self.closed = False
+        # Range which is read (range_start - read_end) or requested to be read (read_end - requested_end)
+        self.range_start = 0
+        self.read_end = 0
+        self.requested_end = 0
+        self.reset_stats()
+        # Single thread, so that the reads are sequential
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.chunk_read.connect(self.on_chunk_read)
+
+    def reset_stats(self):
+        # Playback positions found in the read range or outside of it, bytes read and the time it took
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def set_file(self, file_path):
+        self.generation += 1
+        self.reset_stats()
+        try:
+            self.size = os.path.getsize(file_path)
+            self.file_path = file_path
+        except OSError:
+            self.file_path = None
+        self.range_start = self.read_end = self.requested_end = 0
+
+    # called with the playback position, reads further when the window isn't covered anymore
+    def update(self, position, duration):
+        if self.file_path is None or duration <= 0:
+            return
+        # Average bitrate of the file in bytes per millisecond
+        bitrate = self.size / duration
+        offset = min(self.size, int(position * bitrate))
+        window = min(max(int(READ_AHEAD_SECONDS * 1000 * bitrate), READ_AHEAD_MIN_SIZE), READ_AHEAD_MAX_SIZE)
+
+        if self.range_start <= offset <= self.read_end:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if not self.range_start <= offset <= self.requested_end:
+                # Seek out of the range, reading is restarted from the new position
+                self.generation += 1
+                self.range_start = self.read_end = self.requested_end = offset
+
+        # Window is extended by whole chunks, except at the end of the file
+        end = min(self.size, offset + window)
+        if end - self.requested_end >= min(READ_AHEAD_CHUNK_SIZE, self.size - self.requested_end) > 0:
+            self.executor.submit(self.read, self.generation, self.file_path, self.requested_end, end)
+            self.requested_end = end
+
+    # reads the beginning of the file which is likely to be played next
+    def warm(self, file_path):
+        if file_path:
+            self.executor.submit(self.read, -1, file_path, 0, READ_AHEAD_WARM_SIZE)
+
+    # runs on the background thread
+    def read(self, generation, file_path, start, end):
+        buffer = memoryview(bytearray(READ_AHEAD_CHUNK_SIZE))
+        try:
+            with open(file_path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    # Kernel reads further ahead by itself on sequential access
+                    os.posix_fadvise(f.fileno(), start, end - start, os.POSIX_FADV_SEQUENTIAL)
+                f.seek(start)
+                offset = start
+                while offset < end and not self.closed:
+                    if generation != -1 and generation != self.generation:
+                        return
+                    read_start = time.perf_counter()
+                    read_size = f.readinto(buffer[:min(READ_AHEAD_CHUNK_SIZE, end - offset)])
+                    if not read_size:
+                        return
+                    offset += read_size
+                    # Signal is delivered to the GUI thread
+                    self.chunk_read.emit(generation, offset, read_size, time.perf_counter() - read_start)
+        except OSError as e:
+            print("Failed to read ahead:", file_path, e)
+
+    def on_chunk_read(self, generation, end, size, seconds):
+        self.bytes_read += size
+        self.read_seconds += seconds
+        if generation == self.generation and end > self.read_end:
+            self.read_end = end
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            'mb_read': round(self.bytes_read / 2 ** 20, 1),
+            'mb_per_second': round(self.bytes_read / 2 ** 20 / self.read_seconds, 1) if self.read_seconds else None
+        }
+
+    def close(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
+
+
+# Coalesces seeks, so that the backend gets at most one seek per frame and none while it's busy with the previous
+# one: slider drags keep only the latest target and repeated jumps (arrow keys, replay/forward buttons) are added up
+# into one jump, which is sent when the player confirms the previous seek
+class SeekScheduler(QObject):
+    # seek-to-resume latency in ms
+    seek_finished = pyqtSignal(int)
+
+    def __init__(self, media_player):
+        super().__init__()
+        self.media_player = media_player
+        # Absolute target of the pending seek (None - relative to the current position) and the jump to add
+        self.pending_position = None
+        self.pending_offset = 0
+        # Target and start time of the seek the backend is busy with
+        self.seek_target = None
+        self.seek_start = 0
+        self.latencies = deque(maxlen=SEEK_LATENCY_HISTORY)
+
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(SEEK_FRAME_INTERVAL)
+        self.frame_timer.timeout.connect(self.apply)
+        self.seek_timer = QTimer(self)
+        self.seek_timer.setSingleShot(True)
+        self.seek_timer.setInterval(SEEK_PENDING_TIMEOUT * 1000)
+        self.seek_timer.timeout.connect(self.on_seek_timeout)
+        self.media_player.positionChanged.connect(self.on_position_changed)
+
+    # player is replaced when the preloaded file of the queue is started
+    def set_media_player(self, media_player):
+        self.media_player.positionChanged.disconnect(self.on_position_changed)
+        self.media_player = media_player
+        self.media_player.positionChanged.connect(self.on_position_changed)
+        self.reset()
+
+    def seek_to(self, position):
+        self.pending_position = position
+        self.pending_offset = 0
+        self.schedule()
+
+    def seek_by(self, offset):
+        self.pending_offset += offset
+        self.schedule()
+
+    def schedule(self):
+        # While the previous seek isn't finished, the pending one is held and sent after it
+        if self.seek_target is None and not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def apply(self):
+        self.frame_timer.stop()
+        position = self.pending_position if self.pending_position is not None else self.media_player.position()
+        position = max(0, position + self.pending_offset)
+        duration = self.media_player.duration()
+        if duration and position >= duration:
+            position = max(0, duration - 1000)
+        self.pending_position = None
+        self.pending_offset = 0
+
+        self.seek_target = position
+        self.seek_start = time.perf_counter()
+        self.seek_timer.start()
+        self.media_player.setPosition(position)
+
+    # sends the seek held while the previous one was running
+    def apply_pending(self):
+        if self.pending_position is not None or self.pending_offset:
+            self.apply()
+
+    # seek is finished when the player reports a position near its target
+    def on_position_changed(self, position):
+        if self.seek_target is not None and 0 <= position - self.seek_target < SEEK_TOLERANCE:
+            latency = int((time.perf_counter() - self.seek_start) * 1000)
+            self.latencies.append(latency)
+            self.seek_target = None
+            self.seek_timer.stop()
+            self.seek_finished.emit(latency)
+            self.apply_pending()
+
+    # unconfirmed seek is considered finished
+    def on_seek_timeout(self):
+        # Player may still report the old position, so held jumps are added to the target of that seek
+        if self.pending_position is None and self.pending_offset:
+            self.pending_position = self.seek_target
+        self.seek_target = None
+        self.apply_pending()
+
+    # seeks without waiting for the next frame or the previous seek
+    def seek_now(self, position):
+        self.seek_to(position)
+        self.apply()
+
+    # clears the state when another file is opened
+    def reset(self):
+        self.frame_timer.stop()
+        self.seek_timer.stop()
+        self.pending_position = None
+        self.pending_offset = 0
+        self.seek_target = None
+
+
+# Opt-in playback performance telemetry: open-to-first-frame and resume seek latency, buffering and stalled
+# periods, seek latency, errors and GUI event loop lag. Events are appended to a rolling JSONL file and
+# summarized in a Prometheus-style text file, both written on a background thread
+class PlaybackTelemetry(QObject):
+    def __init__(self, media_player, seek_scheduler, telemetry_dir):
+        super().__init__()
+        self.media_player = media_player
+        self.events_file = os.path.join(telemetry_dir, TELEMETRY_EVENTS_FILE)
+        self.metrics_file = os.path.join(telemetry_dir, TELEMETRY_METRICS_FILE)
+        self.file_path = None
+        # Time the current file was opened, open_time is cleared once its first frame is ready
+        self.media_open_time = None
+        self.open_time = None
+        self.resume_seek_pending = False
+        # Status and start time of the current buffering or stalled period
+        self.stall_status = None
+        self.stall_start = None
+        # Events which are not written yet and metric name -> [count, sum, max] (sum and max are None for counters)
+        self.events = []
+        self.metrics = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        media_player.mediaStatusChanged.connect(self.on_media_status_changed)
+        media_player.error.connect(self.on_error)
+        seek_scheduler.seek_finished.connect(self.on_seek_finished)
+
+        # Event loop lag is the delay of a timer which should fire every EVENT_LOOP_CHECK_INTERVAL
+        self.lag_timer = QTimer(self)
+        self.lag_timer.setInterval(EVENT_LOOP_CHECK_INTERVAL)
+        self.lag_timer.timeout.connect(self.check_event_loop_lag)
+        self.last_lag_check = time.monotonic()
+        self.lag_timer.start()
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setInterval(TELEMETRY_FLUSH_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush)
+        self.flush_timer.start()
+
+    def set_media_player(self, media_player):
+        self.media_player.mediaStatusChanged.disconnect(self.on_media_status_changed)
+        self.media_player.error.disconnect(self.on_error)
+        self.media_player = media_player
+        media_player.mediaStatusChanged.connect(self.on_media_status_changed)
+        media_player.error.connect(self.on_error)
+
+    def media_opened(self, file_path):
+        self.end_stall()
+        self.file_path = file_path
+        self.media_open_time = self.open_time = time.monotonic()
+        self.resume_seek_pending = False
+
+    def resume_seek_started(self):
+        self.resume_seek_pending = True
+
+    def on_media_status_changed(self, status):
+        if status == QMediaPlayer.BufferedMedia and self.open_time is not None:
+            self.record('open_to_first_frame', (time.monotonic() - self.open_time) * 1000)
+            self.open_time = None
+
+        if status in (QMediaPlayer.BufferingMedia, QMediaPlayer.StalledMedia):
+            # Buffering before the first frame is part of the opening time
+            if self.open_time is None and self.stall_status != status:
+                self.end_stall()
+                self.stall_status = status
+                self.stall_start = time.monotonic()
+        else:
+            self.end_stall()
+            if status == QMediaPlayer.InvalidMedia:
+                self.record('invalid_media')
+
+    def end_stall(self):
+        if self.stall_start is not None:
+            name = 'stalled' if self.stall_status == QMediaPlayer.StalledMedia else 'buffering'
+            self.record(name, (time.monotonic() - self.stall_start) * 1000)
+            self.stall_status = None
+            self.stall_start = None
+
+    def on_error(self, error):
+        self.record('error', code=int(error), message=self.media_player.errorString())
+
+    def on_seek_finished(self, latency):
+        if self.resume_seek_pending:
+            # Resume is measured from opening the file
+            self.record('time_to_resume', (time.monotonic() - self.media_open_time) * 1000)
+            self.resume_seek_pending = False
+        else:
+            self.record('seek', latency)
+
+    def check_event_loop_lag(self):
+        now = time.monotonic()
+        lag = (now - self.last_lag_check) * 1000 - EVENT_LOOP_CHECK_INTERVAL
+        self.last_lag_check = now
+        if lag > EVENT_LOOP_LAG_THRESHOLD:
+            self.record('event_loop_lag', lag)
+
+    def record(self, name, milliseconds=None, **details):
+        event = {'time': datetime.now().isoformat(timespec='milliseconds'), 'event': name, 'file': self.file_path}
+        metric = self.metrics.setdefault(name, [0, None, None])
+        metric[0] += 1
+        if milliseconds is not None:
+            event['ms'] = round(milliseconds, 1)
+            metric[1] = (metric[1] or 0) + milliseconds
+            metric[2] = max(metric[2] or 0, milliseconds)
+        event.update(details)
+        self.events.append(event)
+
+    def flush(self):
+        events, self.events = self.events, []
+        metrics = {name: list(metric) for name, metric in self.metrics.items()}
+        self.executor.submit(self.write, events, metrics)
+
+    # runs on the background thread
+    def write(self, events, metrics):
+        if events:
+            # Keeps one previous file, so the events take at most twice TELEMETRY_MAX_FILE_SIZE
+            if os.path.exists(self.events_file) and os.path.getsize(self.events_file) > TELEMETRY_MAX_FILE_SIZE:
+                os.replace(self.events_file, self.events_file + '.1')
+            with open(self.events_file, 'a', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+
+        lines = []
+        for name, (count, total, maximum) in sorted(metrics.items()):
+            if total is None:
+                lines += [f'# TYPE player_{name}_total counter', f'player_{name}_total {count}']
+                continue
+            metric_name = f'player_{name}_ms'
+            lines += [f'# TYPE {metric_name} summary',
+                      f'{metric_name}_count {count}',
+                      f'{metric_name}_sum {total:.1f}',
+                      f'# TYPE {metric_name}_max gauge',
+                      f'{metric_name}_max {maximum:.1f}']
+        temp_file = self.metrics_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, self.metrics_file)
+
+    def close(self):
+        self.end_stall()
+        self.lag_timer.stop()
+        self.flush_timer.stop()
+        self.flush()
+        self.executor.shutdown(wait=True)
+
 
 # Custom widget allows to control volume and hide volume slider when it's not needed
 class VolumeWidget(QWidget):
@@ -109,11 +1844,73 @@ INITIAL_VOLUME = 15
 BUTTON_ICON_SIZE = QSize(25, 25)
 INITIAL_DIR = 'D:/My documents/Downloads'
 FILE_FILTER = 'Video and Music Files (*.mp4 *.avi *.mkv *.wmv *.mp3 *.flac *.m4a)'
+PLAYLIST_FILTER = 'Playlists (*.m3u *.m3u8)'
+MUSIC_EXTENSIONS = ('.mp3', '.m4a', '.flac')
+MEDIA_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.wmv') + MUSIC_EXTENSIONS
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8')
 DEFAULT_ALBUM_COVER_PATH = 'img/default_album_cover.jpg'
 LOCAL_APP_DATA_ENV = 'LOCALAPPDATA'
 PLAYBACK_DIR = 'PyQtMediaPlayer'
-PLAYBACK_FILE = 'playback_state.json'
-MAX_PLAYBACK_POSITIONS = 100
+PLAYBACK_FILE = 'playback_state.json'  # old format, migrated to the database
+PLAYBACK_DB = 'playback_state.db'
+MAX_PLAYBACK_POSITIONS = 100000
+FINGERPRINT_CHUNK_SIZE = 64 * 1024  # bytes read at every fingerprint offset
+DB_BUSY_TIMEOUT = 10  # seconds to wait for other instances to finish writing
+CHECKPOINT_INTERVAL = 5  # seconds between background saves of the playback position
+COVER_LOADER_THREADS = 2
+COVER_CACHE_DIR = 'cover_cache'
+COVER_CACHE_MAX_SIZE = 200 * 1024 * 1024  # bytes
+DEFAULT_COVER_SIZE_LIMIT = 1920  # px, largest side of covers if the screen size is unknown
+NO_COVER_SUFFIX = '.none'
+SCALED_PIXMAP_CACHE_SIZE = 4
+SINGLE_INSTANCE = False  # files opened from the shell are passed to the running player
+INSTANCE_SERVER_NAME = 'AlexMultiMedia'
+INSTANCE_CONNECT_TIMEOUT = 200  # ms
+REFRESH_FRAME_INTERVAL = 16  # ms, progress slider and label are refreshed at most once per frame
+SEEK_FRAME_INTERVAL = 16  # ms, seeks are sent to the player at most once per frame
+SEEK_TOLERANCE = 1000  # ms, a seek is finished when the player reports a position this close after its target
+SEEK_PENDING_TIMEOUT = 2  # seconds after which an unconfirmed seek is considered finished
+SEEK_LATENCY_HISTORY = 100
+TELEMETRY = False  # playback performance events and metrics are written to the app data dir
+TELEMETRY_EVENTS_FILE = 'telemetry.jsonl'
+TELEMETRY_METRICS_FILE = 'telemetry.prom'
+TELEMETRY_MAX_FILE_SIZE = 5 * 1024 * 1024  # bytes, the events file is rotated after that
+TELEMETRY_FLUSH_INTERVAL = 10000  # ms
+EVENT_LOOP_CHECK_INTERVAL = 250  # ms
+EVENT_LOOP_LAG_THRESHOLD = 50  # ms, smaller delays of the event loop are not recorded
+PRELOAD_BEFORE_END = 10000  # ms before the end of the current file when the next file of the queue is preloaded
+READ_AHEAD = True  # played files are read ahead of the backend, for network shares and USB disks
+READ_AHEAD_SECONDS = 30  # of playback at the bitrate of the file
+READ_AHEAD_MIN_SIZE = 2 * 1024 * 1024  # bytes
+READ_AHEAD_MAX_SIZE = 128 * 1024 * 1024  # bytes
+READ_AHEAD_CHUNK_SIZE = 1024 * 1024  # bytes
+READ_AHEAD_WARM_SIZE = 4 * 1024 * 1024  # bytes of the next file of the queue which are read in advance
+PLAYLIST_PAGE_SIZE = 1000  # rows added to the playlist panel at once
+PLAYLIST_METADATA_CACHE_SIZE = 1000  # rows of the playlist panel with loaded metadata
+PLAYLIST_LOADER_THREADS = 2
+PLAYLIST_LOAD_DELAY = 50  # ms after scrolling stops before the metadata of the visible rows is loaded
+PLAYLIST_THUMBNAIL_SIZE = 40  # px
+PLAYLIST_PANEL_WIDTH = 380  # px
+LIBRARY_ROOTS = [INITIAL_DIR]  # folders of the media library, indexed in the background
+LIBRARY_DB = 'library.db'
+LIBRARY_SCAN_DELAY = 5000  # ms after the startup before the library is rescanned, so it doesn't slow down playback
+LIBRARY_SCAN_THREADS = 8
+LIBRARY_BATCH_SIZE = 500  # files whose tags are read and written to the index in one transaction
+LIBRARY_WATCH = True  # library roots are watched for changes after the scan
+LIBRARY_UPDATE_DELAY = 300  # ms without changes before they are applied to the library index
+LIBRARY_UPDATE_MAX_DELAY = 1000  # ms, changes of a longer burst are applied in parts
+LIBRARY_WATCH_BATCH_SIZE = 200  # directories added to the file system watcher at once
+LIBRARY_POLL_INTERVAL = 60  # seconds between checks of the directories which can't be watched
+LIBRARY_FILE_POLL_INTERVAL = 15 * 60  # seconds between checks of the files in the directories which can't be watched
+# inotify events of the watched directories and flags of the events
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+# Files are reported once they are written, created files are only watched for new directories
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+RESUME_LOAD_TIMEOUT = 2000  # ms to wait for the media to load before playing it without the saved position
+RESUME_END_MARGIN = 10000  # ms, positions saved this close to the end of a file are not resumed
+VIDEO_IDLE_TIMEOUT = 5 * 60 * 1000  # ms of playing music before the video widget is released (0 - never)
+RESIZE_SETTLE_DELAY = 150  # ms after the last resize step before the album cover is scaled smoothly
 
 
 class MainWindow(QMainWindow):
@@ -141,16 +1938,61 @@ class MainWindow(QMainWindow):
         self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
 
         self.build_player()
+
+        # Playback store is opened and the file is played after the first frame is painted
+        self.startup_pending = True
+
+    def finish_startup(self):
         self.manage_playback_positions()
+        self.manage_library()
 
         if self.file_path:
-            self.play_file()
+            # Argument may also be a folder or a playlist
+            paths, self.file_path = [self.file_path], None
+            self.open_paths(paths)
 
     def manage_playback_positions(self):
         self.app_data_dir = os.path.join(os.getenv(LOCAL_APP_DATA_ENV), PLAYBACK_DIR)
         os.makedirs(self.app_data_dir, exist_ok=True)
         self.playback_file = os.path.join(self.app_data_dir, PLAYBACK_FILE)
-        self.playback_positions = self.load_playback_positions()
+        self.cover_loader.cover_cache = CoverCache(os.path.join(self.app_data_dir, COVER_CACHE_DIR),
+                                                   cover_size=cover_size_limit())
+        self.playback_store = PlaybackStore(os.path.join(self.app_data_dir, PLAYBACK_DB), self.playback_file)
+        self.checkpointer = PlaybackCheckpointer(self.playback_store)
+        self.checkpointer.fingerprint_lookup_finished.connect(self.on_fingerprint_lookup_finished)
+        # Position isn't saved until the saved one is restored, otherwise it would be overwritten with 0
+        self.resume_pending = False
+        # Position of a file which isn't found by its path is looked up by its content
+        self.fingerprint_lookup_pending = False
+        self.telemetry = None
+        if TELEMETRY:
+            self.telemetry = PlaybackTelemetry(self.mediaPlayer, self.seek_scheduler, self.app_data_dir)
+
+    def manage_library(self):
+        self.library_index = LibraryIndex(os.path.join(self.app_data_dir, LIBRARY_DB))
+        self.library_scanner = LibraryScanner(self.library_index, LIBRARY_ROOTS)
+        self.library_scanner.library_listed.connect(self.on_library_listed)
+        self.library_scanner.library_changed.connect(self.on_library_changed)
+        self.library_watcher = LibraryWatcher(self.library_scanner, LIBRARY_ROOTS) if LIBRARY_WATCH else None
+        # Playlist panel shows the library, it is edited in place when the library changes
+        self.library_shown = False
+        self.library_version = 0
+        QTimer.singleShot(LIBRARY_SCAN_DELAY, self.update_library)
+
+    # rescans the library and watches it for changes after that
+    def update_library(self):
+        self.library_scanner.scan()
+        if self.library_watcher:
+            self.library_watcher.start()
+
+    # updates the shown library in place, the panel, the played file and the preloaded one are kept as they are
+    def on_library_changed(self, version, edits):
+        # Edits of a list which isn't shown anymore
+        if not self.library_shown or version != self.library_version + 1:
+            return
+        self.library_version = version
+        self.queue.apply_edits(edits)
+        self.playlist_model.apply_edits(edits)
 
     def build_player(self):
         self.central_widget = QWidget(self)
@@ -158,43 +2000,91 @@ class MainWindow(QMainWindow):
 
         self.media_layout = QVBoxLayout(self.central_widget)
         self.media_layout.setContentsMargins(0, 0, 0, 0)
-        # Widget to show output for video files
-        self.video_widget = QVideoWidget()
-        self.media_layout.addWidget(self.video_widget)
+        # Widget to show output for video files, created when the first video is opened
+        self.video_widget = None
         # Label to show output (album cover image) for music files
         self.image_label = ImageLabel()
         self.media_layout.addWidget(self.image_label)
         self.image_label.setAlignment(Qt.AlignCenter)
 
+        # Album covers are read in the background, results of previously opened files are ignored
+        self.cover_loader = CoverLoader()
+        self.cover_loader.cover_loaded.connect(self.on_cover_loaded)
+        self.last_cover_request_id = 0
+        self.cover_request_id = 0
+
+        # Playlist panel, toggled with 'L'
+        self.playlist_model = PlaylistModel()
+        self.playlist_panel = PlaylistPanel(self.playlist_model, self.central_widget)
+        self.playlist_panel.activated.connect(lambda index: self.play_queue_row(index.row()))
+        self.playlist_panel.hide()
+
         self.create_controls()
         self.enable_controls(False)
         self.create_shortcuts()
 
-        self.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
-        self.mediaPlayer.setVideoOutput(self.video_widget)
-
-        # Timer to update the playback time label
-        self.playback_time_timer = QTimer(self)
-        self.playback_time_timer.setInterval(1000)  # update every second
-        self.playback_time_timer.timeout.connect(self.update_time_label)
-        self.playback_time_timer.start()
+        # Video output is attached when the first video is opened, music doesn't need it
+        self.mediaPlayer = QMediaPlayer(None)
+
+        # Second player loads the next file of the queue before the current one ends, the players are swapped
+        # when the next file starts, so it plays without waiting for the file to be opened and buffered
+        self.queue = PlaybackQueue()
+        self.next_player = QMediaPlayer(None)
+        self.preloaded_path = None
+        # Cover of the preloaded file and the id of its request
+        self.preload_cover_request_id = None
+        self.preloaded_cover = None
+
+        # Timer to release the video widget after some time of playing music only
+        self.video_idle_timer = QTimer(self)
+        self.video_idle_timer.setSingleShot(True)
+        self.video_idle_timer.setInterval(VIDEO_IDLE_TIMEOUT)
+        self.video_idle_timer.timeout.connect(self.release_video_widget)
+
+        # Timer to refresh the progress slider and label at most once per frame. It only runs after
+        # the player reports a change, so nothing is refreshed while playback is paused
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_FRAME_INTERVAL)
+        self.refresh_timer.timeout.connect(self.update_time_label)
 
         # Timer to distinguish single and double clicks
         self.click_detection_timer = QTimer()
         self.click_detection_timer.setSingleShot(True)
         self.click_detection_timer.timeout.connect(self.single_click_handler)
 
+        self.seek_scheduler = SeekScheduler(self.mediaPlayer)
+
+        self.prefetcher = ReadAheadPrefetcher() if READ_AHEAD else None
+
+        # Timer to start playback if the backend doesn't report LoadedMedia in time,
+        # the saved position is then applied once the media is buffered
+        self.resume_timer = QTimer(self)
+        self.resume_timer.setSingleShot(True)
+        self.resume_timer.setInterval(RESUME_LOAD_TIMEOUT)
+        self.resume_timer.timeout.connect(lambda: self.mediaPlayer.play())
+
         # Connect events
-        self.mediaPlayer.stateChanged.connect(self.playing_state_handler)
-        self.mediaPlayer.positionChanged.connect(self.position_handler)
-        self.mediaPlayer.durationChanged.connect(self.duration_handler)
-        # Connect media status change to check when the media is buffered
-        self.mediaPlayer.mediaStatusChanged.connect(self.on_media_status_changed)
+        self.attach_player(self.mediaPlayer)
 
         self.previous_volume = INITIAL_VOLUME
 
-        # Set player's initial volume
+        # Set players' initial volume
         self.mediaPlayer.setVolume(INITIAL_VOLUME)
+        self.next_player.setVolume(INITIAL_VOLUME)
+
+    def attach_player(self, player):
+        player.stateChanged.connect(self.playing_state_handler)
+        player.positionChanged.connect(self.position_handler)
+        player.durationChanged.connect(self.duration_handler)
+        # Connect media status change to check when the media is buffered
+        player.mediaStatusChanged.connect(self.on_media_status_changed)
+
+    def detach_player(self, player):
+        player.stateChanged.disconnect(self.playing_state_handler)
+        player.positionChanged.disconnect(self.position_handler)
+        player.durationChanged.disconnect(self.duration_handler)
+        player.mediaStatusChanged.disconnect(self.on_media_status_changed)
 
     def create_controls(self):
         # Play/Pause button
@@ -277,47 +2167,247 @@ class MainWindow(QMainWindow):
         self.show_controls_shortcut = QShortcut(Qt.Key_Up, self)
         self.show_controls_shortcut.activated.connect(lambda: self.show_controls(True))
 
+        # Next file shortcuts - 'Page Down' and the media key
+        self.next_shortcuts = [QShortcut(key, self) for key in (Qt.Key_PageDown, Qt.Key_MediaNext)]
+        # Previous file shortcuts - 'Page Up' and the media key
+        self.previous_shortcuts = [QShortcut(key, self) for key in (Qt.Key_PageUp, Qt.Key_MediaPrevious)]
+        for shortcut in self.next_shortcuts:
+            shortcut.activated.connect(self.play_next)
+        for shortcut in self.previous_shortcuts:
+            shortcut.activated.connect(self.play_previous)
+
+        # Show/Hide Playlist shortcut - 'L'
+        self.playlist_shortcut = QShortcut(Qt.Key_L, self)
+        self.playlist_shortcut.activated.connect(self.toggle_playlist)
+
+        # Open Library shortcut - 'Ctrl+L'
+        self.library_shortcut = QShortcut(Qt.CTRL + Qt.Key_L, self)
+        self.library_shortcut.activated.connect(self.open_library)
+
+        # Open Folder shortcut - 'Ctrl+Shift+O'
+        self.open_folder_shortcut = QShortcut(Qt.CTRL + Qt.SHIFT + Qt.Key_O, self)
+        self.open_folder_shortcut.activated.connect(self.open_folder)
+
+    # several files or a playlist can be selected
     def open_file(self):
+        file_paths, _ = QFileDialog.getOpenFileNames(self, 'Open File', INITIAL_DIR,
+                                                     f'{FILE_FILTER};;{PLAYLIST_FILTER}')
+        self.open_paths(file_paths)
+
+    def open_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, 'Open Folder', INITIAL_DIR)
+        if folder:
+            self.open_paths([folder])
+
+    # folders and playlists are expanded into the queue, its first file is played
+    def open_paths(self, paths):
+        # Dialog was cancelled
+        if not paths:
+            return
+        files = expand_media_paths(paths)
+        if not files:
+            print("No media files to play:", paths)
+            return
+        self.queue.set_files(files)
+        self.playlist_model.set_files(self.queue.files)
+        self.library_shown = False
+        self.play_queued_file(self.queue.current())
+
+    # shows the indexed files in the playlist panel, playback goes on until another file is chosen
+    def open_library(self):
+        # Files are listed in the background
+        self.library_scanner.list_files()
+
+    def on_library_listed(self, version, files):
+        if not files:
+            print("Library is empty:", LIBRARY_ROOTS)
+            return
+        index = files.index(self.file_path) if self.file_path in files else -1
+        self.clear_preload()
+        self.queue.set_files(files, index)
+        self.playlist_model.set_files(self.queue.files)
+        self.library_shown = True
+        self.library_version = version
+        self.playlist_panel.show()
+        self.playlist_panel.raise_()
+        if index >= 0:
+            self.playlist_panel.show_row(index)
+
+    def toggle_playlist(self):
+        self.playlist_panel.setVisible(not self.playlist_panel.isVisible())
+        if self.playlist_panel.isVisible():
+            self.playlist_panel.raise_()
+
+    # file chosen in the playlist panel
+    def play_queue_row(self, row):
+        file_path = self.queue.select(row)
+        if file_path:
+            self.play_queued_file(file_path)
+
+    def play_next(self):
+        file_path = self.queue.next()
+        if file_path:
+            self.play_queued_file(file_path)
+
+    def play_previous(self):
+        file_path = self.queue.previous()
+        if file_path:
+            self.play_queued_file(file_path)
+
+    def play_queued_file(self, file_path):
         self.save_playback_position()
-        self.file_path, _ = QFileDialog.getOpenFileName(self, 'Open File', INITIAL_DIR, FILE_FILTER)
-        self.play_file()
+        self.file_path = file_path
+        preloaded = file_path == self.preloaded_path
+        if preloaded:
+            self.swap_players()
+        self.play_file(preloaded)
+        self.clear_preload()
+        self.playlist_panel.show_row(self.queue.index)
+
+    # next file of the queue is loaded by the second player shortly before the current one ends
+    def preload_next_file(self, position):
+        next_file_path = self.queue.peek_next()
+        if next_file_path is None or next_file_path == self.preloaded_path:
+            return
+        duration = self.mediaPlayer.duration()
+        if not duration or duration - position > PRELOAD_BEFORE_END:
+            return
+        self.clear_preload()
+        self.preloaded_path = next_file_path
+        self.next_player.setMedia(QMediaContent(QUrl.fromLocalFile(next_file_path)))
+        if next_file_path.endswith(MUSIC_EXTENSIONS):
+            self.preload_cover_request_id = self.load_album_cover(next_file_path)
+
+    def clear_preload(self):
+        self.preloaded_path = None
+        self.preload_cover_request_id = None
+        self.preloaded_cover = None
+        if self.next_player.mediaStatus() != QMediaPlayer.NoMedia:
+            self.next_player.setMedia(QMediaContent())
+
+    # player with the preloaded file becomes the current one, the other one is kept for the next preload
+    def swap_players(self):
+        previous_player = self.mediaPlayer
+        self.detach_player(previous_player)
+        previous_player.stop()
+        self.mediaPlayer, self.next_player = self.next_player, previous_player
+        self.attach_player(self.mediaPlayer)
+        if self.video_widget is not None:
+            self.mediaPlayer.setVideoOutput(self.video_widget)
+        self.seek_scheduler.set_media_player(self.mediaPlayer)
+        if self.telemetry:
+            self.telemetry.set_media_player(self.mediaPlayer)
+
+    def start_instance_server(self):
+        self.instance_server = InstanceServer()
+        self.instance_server.file_received.connect(self.on_file_received)
+        if not self.instance_server.listen():
+            print("Failed to start instance server:", self.instance_server.server.errorString())
+
+    # file opened in the shell while this player is running
+    def on_file_received(self, file_path):
+        if file_path:
+            self.open_paths([file_path])
+        if self.isMinimized():
+            self.showNormal()
+        self.raise_()
+        self.activateWindow()
 
-    def play_file(self):
+    def play_file(self, preloaded=False):
         if self.file_path != '':
-            self.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(self.file_path)))
+            self.resume_pending = True
+            self.seek_scheduler.reset()
+            if self.telemetry:
+                self.telemetry.media_opened(self.file_path)
+            if preloaded:
+                # Player reported the loading while it was in the background
+                self.duration_handler(self.mediaPlayer.duration())
+                if self.telemetry:
+                    self.telemetry.on_media_status_changed(self.mediaPlayer.mediaStatus())
+            else:
+                self.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(self.file_path)))
             self.enable_controls(True)
 
-            if self.file_path.endswith(('.mp3', '.m4a', '.flac')):
+            if self.file_path.endswith(MUSIC_EXTENSIONS):
                 self.image_label.show()
-                self.video_widget.hide()
+                if self.video_widget:
+                    self.video_widget.hide()
+                    # Countdown goes on through the following music files
+                    if VIDEO_IDLE_TIMEOUT and not self.video_idle_timer.isActive():
+                        self.video_idle_timer.start()
                 self.display_album_cover()
             else:
                 self.image_label.hide()
+                self.video_idle_timer.stop()
+                self.create_video_widget()
                 self.video_widget.show()
 
-            self.play()
+            # Saved position is applied as soon as the media is loaded and playback starts after that,
+            # so the beginning of the file is not decoded and played before the seek
+            self.resume_position = self.checkpointer.get(self.file_path)
+            # File may have been moved or renamed since its position was saved. It's played from the beginning
+            # without waiting, the position found by its content is applied as a seek
+            self.fingerprint_lookup_pending = self.resume_position is None
+            if self.fingerprint_lookup_pending:
+                self.checkpointer.find_by_fingerprint(self.file_path)
+            if self.prefetcher:
+                self.report_read_ahead_stats()
+                self.prefetcher.set_file(self.file_path)
+                self.prefetcher.warm(self.queue.peek_next())
+            if not self.resume_position:
+                self.resume_pending = False
+                self.mediaPlayer.play()
+            elif self.media_loaded():
+                # Preloaded file can be sought right away
+                self.resume_playback()
+            else:
+                self.resume_timer.start()
             self.show_controls(False)
             self.setWindowTitle(f'{APP_NAME} - {os.path.basename(self.file_path)}')
 
+    # video pipeline (QtMultimediaWidgets) is only loaded when it's needed
+    def create_video_widget(self):
+        if self.video_widget is None:
+            from PyQt5.QtMultimediaWidgets import QVideoWidget
+            self.video_widget = QVideoWidget()
+            self.media_layout.insertWidget(0, self.video_widget)
+            self.mediaPlayer.setVideoOutput(self.video_widget)
+            # Controls bar and playlist have to stay on top of the new widget
+            self.controls_bar.raise_()
+            self.playlist_panel.raise_()
+
+    # detaches the video output from the player, its decoder resources are freed with the widget
+    def release_video_widget(self):
+        if self.video_widget is not None and not self.video_widget.isVisible():
+            self.media_layout.removeWidget(self.video_widget)
+            self.video_widget.deleteLater()
+            self.video_widget = None
+
+    # shows the preloaded cover, or the default one until the real one is read in the background
     def display_album_cover(self):
-        if self.file_path.endswith('.mp3'):
-            audio = MP3(self.file_path, ID3=ID3)
-            for tag in audio.tags.values():
-                if isinstance(tag, APIC):
-                    self.image_label.setPixmap(tag.data)
-                    return
-        elif self.file_path.endswith('.flac'):
-            audio = FLAC(self.file_path)
-            for picture in audio.pictures:
-                self.image_label.setPixmap(picture.data)
-                return
-        elif self.file_path.endswith('.m4a'):
-            audio = MP4(self.file_path)
-            for cover in audio.tags.get('covr', []):
-                if cover.imageformat == MP4Cover.FORMAT_JPEG or cover.imageformat == MP4Cover.FORMAT_PNG:
-                    self.image_label.setPixmap(cover)
-                    return
-        self.image_label.setPixmapPath(resource_path(DEFAULT_ALBUM_COVER_PATH))
+        if self.preload_cover_request_id is not None and self.file_path == self.preloaded_path:
+            self.cover_request_id = self.preload_cover_request_id
+            data = self.preloaded_cover
+        else:
+            self.cover_request_id = self.load_album_cover(self.file_path)
+            data = None
+        if data:
+            self.image_label.setPixmap(data)
+        else:
+            self.image_label.setPixmapPath(resource_path(DEFAULT_ALBUM_COVER_PATH))
+
+    # reads the cover in the background, returns the id of the request
+    def load_album_cover(self, file_path):
+        self.last_cover_request_id += 1
+        self.cover_loader.load(self.last_cover_request_id, file_path)
+        return self.last_cover_request_id
+
+    def on_cover_loaded(self, request_id, data):
+        # Ignore covers of the files which are not played or preloaded anymore
+        if request_id == self.cover_request_id and data:
+            self.image_label.setPixmap(data)
+        elif request_id == self.preload_cover_request_id:
+            self.preloaded_cover = data
 
     def enable_controls(self, enabled):
         self.play_button.setEnabled(enabled)
@@ -337,28 +2427,52 @@ class MainWindow(QMainWindow):
             self.play_button.setIcon(self.pause_icon)
         else:
             self.play_button.setIcon(self.play_icon)
+        self.save_playback_position()
 
     def position_handler(self, position):
-        self.progress_slider.setValue(position)
-        self.update_time_label()
+        self.schedule_refresh()
+        # Regular playback and seeks, writes are debounced by the checkpointer
+        self.save_playback_position()
+        self.preload_next_file(position)
+        if self.prefetcher:
+            self.prefetcher.update(position, self.mediaPlayer.duration())
 
     def duration_handler(self, duration):
         self.progress_slider.setRange(0, duration)
+        self.schedule_refresh()
 
     def set_position(self, position):
-        self.mediaPlayer.setPosition(position)
+        self.fingerprint_lookup_pending = False
+        self.seek_scheduler.seek_to(position)
 
     def show_controls(self, show):
         if (show):
             self.controls_bar.show()
+            # Slider and label were not refreshed while the controls were hidden
+            self.update_time_label()
         else:
             self.controls_bar.hide()
 
+    # controls are not refreshed while nobody can see them
+    def controls_visible(self):
+        return self.controls_bar.isVisible() and not self.isMinimized()
+
+    def schedule_refresh(self):
+        if self.controls_visible() and not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    # updates the progress slider and the label, which is only redrawn when its text changes
     def update_time_label(self):
+        if not self.controls_visible():
+            return
         current_time = self.mediaPlayer.position()
         total_time = self.mediaPlayer.duration()
+        # Slider isn't moved from under the mouse while it's dragged
+        if not self.progress_slider.isSliderDown():
+            self.progress_slider.setValue(current_time)
         formatted_time = f'{self.format_time(current_time)} / {self.format_time(total_time)}'
-        self.progress_label.setText(formatted_time)
+        if formatted_time != self.progress_label.text():
+            self.progress_label.setText(formatted_time)
 
     def format_time(self, ms):
         seconds = (ms / 1000) % 60
@@ -386,19 +2500,16 @@ class MainWindow(QMainWindow):
             self.volume_widget.volume_button.setIcon(self.volume_widget.volume_icon)
             self.previous_volume = value
         self.mediaPlayer.setVolume(value)
+        self.next_player.setVolume(value)
 
+    # repeated jumps are added up by the seek scheduler, the position is kept between 0 and duration - 1 second
     def rewind_media(self, rewind_time):
-        current_position = self.mediaPlayer.position()
-        new_position = max(0, current_position - rewind_time)
-        self.mediaPlayer.setPosition(new_position)
+        self.fingerprint_lookup_pending = False
+        self.seek_scheduler.seek_by(-rewind_time)
 
     def forward_media(self, forward_time):
-        current_position = self.mediaPlayer.position()
-        duration = self.mediaPlayer.duration()
-        new_position = current_position + forward_time
-        if new_position >= duration:
-            new_position = duration - 1000
-        self.mediaPlayer.setPosition(new_position)
+        self.fingerprint_lookup_pending = False
+        self.seek_scheduler.seek_by(forward_time)
 
     # toggle between hidden and visible controls
     def single_click_handler(self):
@@ -409,35 +2520,59 @@ class MainWindow(QMainWindow):
 
     # saves playback position with a timestamp (date and time) in a human-readable format
     def save_playback_position(self):
-        if self.file_path:
-            self.playback_positions[self.file_path] = {
-                "position": self.mediaPlayer.position(),
-                "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-
-    # stores up to 100 latest playback positions in json file
-    def write_playback_positions(self):
-        # If there are more than 100 entries, remove the oldest ones by timestamp
-        if len(self.playback_positions) > MAX_PLAYBACK_POSITIONS:
-            sorted_positions = sorted(self.playback_positions.items(), key=lambda item: item[1]['timestamp'])
-            self.playback_positions = dict(sorted_positions[-MAX_PLAYBACK_POSITIONS:])
-
-        with open(self.playback_file, 'w') as f:
-            json.dump(self.playback_positions, f, indent=4)
+        if self.file_path and not self.resume_pending:
+            # File played to the end starts from the beginning next time
+            ended = self.mediaPlayer.mediaStatus() == QMediaPlayer.EndOfMedia
+            self.checkpointer.checkpoint(self.file_path, 0 if ended else self.mediaPlayer.position())
 
-    def load_playback_positions(self):
-        if os.path.exists(self.playback_file):
-            with open(self.playback_file, 'r') as f:
-                return json.load(f)
-        return {}
+    # read-ahead hits, misses and throughput of the previous file are added to the telemetry
+    def report_read_ahead_stats(self):
+        if self.telemetry and self.prefetcher.file_path:
+            self.telemetry.record('read_ahead', file=self.prefetcher.file_path, **self.prefetcher.stats())
 
     def on_media_status_changed(self, status):
-        if status == QMediaPlayer.BufferedMedia:
-            # Resume playback if a position was saved
-            if self.file_path in self.playback_positions:
-                # Rewind by 5 seconds (5000 milliseconds), but don't go below 0
-                position = max(0, int(self.playback_positions[self.file_path]['position']) - 5000)
-                self.mediaPlayer.setPosition(position)
+        if status == QMediaPlayer.BufferedMedia and startup_profiler.profiler:
+            startup_profiler.profiler.mark('playback start')
+            startup_profiler.profiler.finish(self.app_data_dir)
+        # Resume playback once, as early as the backend can seek
+        if self.resume_pending and status in (QMediaPlayer.LoadedMedia, QMediaPlayer.BufferedMedia):
+            self.resume_playback()
+        elif status == QMediaPlayer.EndOfMedia:
+            self.save_playback_position()
+            self.play_next()
+
+    def media_loaded(self):
+        return self.mediaPlayer.mediaStatus() in (QMediaPlayer.LoadedMedia, QMediaPlayer.BufferedMedia)
+
+    def on_fingerprint_lookup_finished(self, file_path, position):
+        # Result of a file which is not played anymore, or which the user has already sought in
+        if file_path != self.file_path or not self.fingerprint_lookup_pending:
+            return
+        self.fingerprint_lookup_pending = False
+        if position:
+            self.resume_position = position
+            # Playback has already started, the position is applied as soon as the backend can seek
+            if self.media_loaded():
+                self.resume_playback()
+            else:
+                self.resume_pending = True
+
+    def resume_playback(self):
+        self.resume_timer.stop()
+        self.resume_pending = False
+        position = int(self.resume_position['position']) if self.resume_position else 0
+        duration = self.mediaPlayer.duration()
+        # File which was stopped right before its end is played from the beginning
+        if duration and duration - position < RESUME_END_MARGIN:
+            position = 0
+        if position:
+            # Rewind by 5 seconds (5000 milliseconds), but don't go below 0
+            position = max(0, position - 5000)
+            if self.telemetry:
+                self.telemetry.resume_seek_started()
+            self.seek_scheduler.seek_now(position)
+        if self.mediaPlayer.state() != QMediaPlayer.PlayingState:
+            self.mediaPlayer.play()
 
     # implementations of the parent methods ↓
 
@@ -458,21 +2593,62 @@ class MainWindow(QMainWindow):
         elif event.key() == Qt.Key_Escape and self.isFullScreen():
             self.showMaximized()
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.startup_pending:
+            self.startup_pending = False
+            # Runs after the painted frame is flushed to the screen
+            QTimer.singleShot(0, self.finish_startup)
+        if startup_profiler.profiler:
+            startup_profiler.profiler.mark('first paint')
+            # Without a file there is no playback to wait for
+            if not self.file_path:
+                QTimer.singleShot(0, lambda: startup_profiler.profiler.finish(getattr(self, 'app_data_dir', None)))
+
+    def changeEvent(self, event):
+        # Refresh the controls when the window is restored after being minimized
+        if event.type() == QEvent.WindowStateChange and not self.isMinimized():
+            self.update_time_label()
+        super().changeEvent(event)
+
     def resizeEvent(self, event):
         self.controls_bar.setGeometry(15, self.height() - 55, self.width() - 30, 40)
+        self.playlist_panel.setGeometry(self.width() - PLAYLIST_PANEL_WIDTH - 15, 15, PLAYLIST_PANEL_WIDTH,
+                                        max(0, self.height() - 85))
 
     def closeEvent(self, event: QCloseEvent) -> None:
         self.save_playback_position()
-        self.write_playback_positions()
+        self.checkpointer.close()
+        self.playback_store.close()
+        if self.library_watcher:
+            self.library_watcher.close()
+        self.library_scanner.close()
+        self.library_index.close()
+        if self.prefetcher:
+            self.report_read_ahead_stats()
+            self.prefetcher.close()
+        if self.telemetry:
+            self.telemetry.close()
         event.accept()
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    if startup_profiler.PROFILE_ARGUMENT in sys.argv:
+        sys.argv.remove(startup_profiler.PROFILE_ARGUMENT)
 
     # sys argument allows to open files with this desktop app
     file_path = sys.argv[1] if len(sys.argv) > 1 else None
+
+    # Running player opens the file, so there is no need to start another one
+    if SINGLE_INSTANCE and forward_to_running_instance(file_path):
+        sys.exit(0)
+
+    app = QApplication(sys.argv)
     window = MainWindow(file_path)
+    if startup_profiler.profiler:
+        startup_profiler.profiler.mark('window created')
+    if SINGLE_INSTANCE:
+        window.start_instance_server()
 
     window.show()
     sys.exit(app.exec_())
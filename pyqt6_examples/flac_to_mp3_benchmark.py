@@ -0,0 +1,203 @@
+"""
+FLAC to MP3 Converter Benchmark
+
+
+This Python script generates a synthetic music library in a temporary directory
+(FLAC tracks with embedded artwork plus filler non-FLAC files) and measures how
+`flac_to_mp3_converter` performs on it:
+- full runs of `copy_converted_files` in sequential, parallel and streaming modes,
+  including the peak resident memory of every run;
+- per-stage costs for a single track: decoding, encoding, tag writing and file copying.
+
+Results are printed and saved as JSON, and can be compared with the results
+of a previous run to see whether a change made the converter faster.
+
+
+Usage:
+    python flac_to_mp3_benchmark.py --tracks 20 --seconds 60 --art-kb 500 --output results.json
+    python flac_to_mp3_benchmark.py --compare results.json
+
+
+Requirements:
+- Same as for `flac_to_mp3_converter.py` (`pydub`, `mutagen`, `ffmpeg`).
+- Peak memory is only reported on systems providing the `resource` module.
+"""
+from pydub import AudioSegment
+from mutagen.flac import FLAC, Picture
+from concurrent.futures import ProcessPoolExecutor
+import flac_to_mp3_converter as converter
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+DEFAULT_TRACKS = 10
+DEFAULT_SECONDS = 30
+DEFAULT_ART_KB = 300
+DEFAULT_FILLER_FILES = 10
+DEFAULT_FILLER_KB = 1024
+DEFAULT_RESULTS_FILE = 'flac_to_mp3_benchmark.json'
+
+
+def generate_library(library_dir, tracks, seconds, art_kb, filler_files, filler_kb):
+    for track in range(tracks):
+        album_dir = os.path.join(library_dir, f'Album {track // 10 + 1}')
+        os.makedirs(album_dir, exist_ok=True)
+        flac_file_path = os.path.join(album_dir, f'{track + 1:02d} Track.flac')
+
+        # Noise doesn't compress, so the tracks are as large as real music
+        subprocess.run([AudioSegment.converter, '-nostdin', '-v', 'error', '-y',
+                        '-f', 'lavfi', '-i', f'anoisesrc=duration={seconds}:sample_rate=44100:amplitude=0.3',
+                        '-ac', '2', flac_file_path], check=True)
+
+        flac_file = FLAC(flac_file_path)
+        flac_file['TITLE'] = f'Track {track + 1}'
+        flac_file['ARTIST'] = 'Benchmark Artist'
+        flac_file['ALBUM'] = f'Album {track // 10 + 1}'
+        flac_file['TRACKNUMBER'] = str(track + 1)
+        if art_kb:
+            picture = Picture()
+            picture.type = 3  # Album front cover
+            picture.mime = 'image/jpeg'
+            picture.data = os.urandom(art_kb * 1024)
+            flac_file.add_picture(picture)
+        flac_file.save()
+
+    for filler in range(filler_files):
+        with open(os.path.join(library_dir, f'Booklet {filler + 1}.pdf'), 'wb') as f:
+            f.write(os.urandom(filler_kb * 1024))
+
+
+# Peak resident memory in MB of this process and of its finished child processes
+def peak_rss():
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return round(self_rss / 2 ** 20, 1), round(children_rss / 2 ** 20, 1)
+
+
+# Runs in a fresh process, so that memory peaks of different runs don't mix
+def full_run(library_dir, output_dir, options):
+    start = time.perf_counter()
+    converter.copy_converted_files(library_dir, output_dir, os.path.join(output_dir, 'CONVERTED'), **options)
+    seconds = time.perf_counter() - start
+    self_rss, children_rss = peak_rss()
+    return {'seconds': round(seconds, 3), 'peak_rss_mb': self_rss, 'peak_children_rss_mb': children_rss}
+
+
+def benchmark_full_runs(library_dir, work_dir, workers):
+    modes = {
+        'sequential': {},
+        'sequential_streaming': {'streaming': True},
+        'parallel': {'workers': workers},
+        'parallel_streaming': {'workers': workers, 'streaming': True},
+        'incremental_first_run': {'workers': workers, 'manifest_file': os.path.join(work_dir, 'manifest.json')},
+        'incremental_no_op': {'workers': workers, 'manifest_file': os.path.join(work_dir, 'manifest.json')},
+    }
+    results = {}
+    for mode, options in modes.items():
+        output_dir = os.path.join(work_dir, 'incremental' if 'manifest_file' in options else mode)
+        with ProcessPoolExecutor(1) as pool:
+            results[mode] = pool.submit(full_run, library_dir, output_dir, options).result()
+        print(f'{mode}: {results[mode]}')
+    return results
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, round(time.perf_counter() - start, 3)
+
+
+def benchmark_stages(library_dir, work_dir):
+    flac_file_path = next(os.path.join(root, file) for root, dirs, files in sorted(os.walk(library_dir))
+                          for file in sorted(files) if file.endswith('.flac'))
+    filler_file_path = next(os.path.join(library_dir, file) for file in sorted(os.listdir(library_dir))
+                            if not file.endswith('.flac') and os.path.isfile(os.path.join(library_dir, file)))
+    mp3_file_path = os.path.join(work_dir, 'stage.mp3')
+
+    audio, decode_seconds = timed(AudioSegment.from_file, flac_file_path, 'flac')
+    _, encode_seconds = timed(lambda: audio.export(mp3_file_path, format='mp3', bitrate='320k').close())
+    flac_file = FLAC(flac_file_path)
+    _, tag_seconds = timed(converter.write_mp3_metadata, flac_file, mp3_file_path)
+    _, streaming_seconds = timed(converter.convert_flac_to_mp3_streaming, flac_file_path, mp3_file_path)
+    # Same copy path as the converter, the identical-file check is skipped so that the data is always copied
+    copy_method, copy_seconds = timed(converter.copy_file, filler_file_path, os.path.join(work_dir, 'stage.copy'),
+                                      converter.COPY_MODE, False)
+
+    results = {
+        'decode': decode_seconds,
+        'encode': encode_seconds,
+        'tag_write': tag_seconds,
+        'streaming_convert': streaming_seconds,
+        'file_copy': copy_seconds,
+        'file_copy_method': copy_method,
+        'file_copy_mb_per_second': round(os.path.getsize(filler_file_path) / 2 ** 20 / max(copy_seconds, 1e-6), 1)
+    }
+    print(f'stages: {results}')
+    return results
+
+
+def compare_results(previous, current):
+    print(f"Comparison with the run from {previous['date']}:")
+    for group in ('full_runs', 'stages'):
+        for name, value in current[group].items():
+            old_value = previous.get(group, {}).get(name)
+            if isinstance(value, dict):
+                value, old_value = value['seconds'], (old_value or {}).get('seconds')
+            if isinstance(value, (int, float)) and old_value and not name.endswith('per_second'):
+                print(f'  {group}.{name}: {old_value} -> {value} s ({value / old_value:.2f}x)')
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='flac_benchmark_')
+    try:
+        library_dir = os.path.join(work_dir, 'library')
+        generate_library(library_dir, args.tracks, args.seconds, args.art_kb, args.filler_files, args.filler_kb)
+
+        results = {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'parameters': {'tracks': args.tracks, 'seconds': args.seconds, 'art_kb': args.art_kb,
+                           'filler_files': args.filler_files, 'filler_kb': args.filler_kb, 'workers': args.workers},
+            'full_runs': benchmark_full_runs(library_dir, work_dir, args.workers),
+            'stages': benchmark_stages(library_dir, work_dir)
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), results)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark flac_to_mp3_converter on a synthetic library')
+    parser.add_argument('--tracks', type=int, default=DEFAULT_TRACKS, help='number of FLAC tracks')
+    parser.add_argument('--seconds', type=int, default=DEFAULT_SECONDS, help='length of every track')
+    parser.add_argument('--art-kb', type=int, default=DEFAULT_ART_KB, help='size of embedded artwork (0 - none)')
+    parser.add_argument('--filler-files', type=int, default=DEFAULT_FILLER_FILES, help='number of non-FLAC files')
+    parser.add_argument('--filler-kb', type=int, default=DEFAULT_FILLER_KB, help='size of every non-FLAC file')
+    parser.add_argument('--workers', type=int, default=converter.WORKERS, help='workers for the parallel runs')
+    parser.add_argument('--output', default=DEFAULT_RESULTS_FILE, help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    run_benchmark(parser.parse_args())
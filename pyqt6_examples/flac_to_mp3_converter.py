@@ -8,6 +8,25 @@ MP3 format, saving the converted files in a separate output directory (`.jpg` ar
 files are ignored). The program automatically creates the two output directories if 
 they do not already exist, ensuring smooth execution.
 
+Conversions can run in parallel: FLAC decoding/encoding and tag copying are done in
+a process pool while the remaining files are copied on a separate I/O thread pool.
+The largest files are scheduled first, and the per-file output is printed in the
+same order as in the sequential mode.
+
+Re-runs are incremental when a manifest file is given: it records size, modification
+time (and optionally a content hash) of every source file together with the output it
+produced, so only new or changed files are processed and outputs of removed sources
+are deleted. Finished files are appended to a journal, which lets an interrupted run
+resume where it stopped.
+
+The streaming mode pipes decoded PCM from one `ffmpeg` process into an encoding one
+in fixed-size chunks, so a track is never held in memory as a whole, and limits the
+memory available to every conversion job (where the OS supports it).
+
+Non-FLAC files are copied inside the kernel (`copy_file_range`/`sendfile`) when possible,
+can be reflinked (copy-on-write clones) or hard-linked instead of copied, and are
+skipped when the destination already holds identical content.
+
 
 Requirements:
 - Python 3.x
@@ -23,13 +42,45 @@ from pydub import AudioSegment
 from mutagen.flac import FLAC
 from mutagen.mp3 import MP3
 from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TCON, TRCK, TDRC, TPE2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import errno
+import functools
+import hashlib
+import io
+import json
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 
 
 INPUT_DIRECTORY = 'D:/My documents/Downloads/Music'
 OUTPUT_COPY_DIRECTORY = 'D:/My documents/Downloads/OUTPUT'
 OUTPUT_CONVERTED_DIRECTORY = 'D:/My documents/Downloads/OUTPUT/CONVERTED'
+# Number of processes converting FLAC files (1 - sequential mode)
+WORKERS = os.cpu_count() or 1
+# Number of threads copying non-FLAC files in parallel mode
+IO_WORKERS = 4
+# Manifest of already processed files (None - process all files on every run)
+MANIFEST_FILE = 'D:/My documents/Downloads/OUTPUT/conversion_manifest.json'
+# Compare content hashes of the files whose modification time changed but size didn't
+USE_HASH = False
+# Convert FLAC files through ffmpeg pipes instead of loading whole tracks into memory
+STREAMING = True
+# Size of PCM chunks passed from the decoder to the encoder in streaming mode
+STREAM_CHUNK_SIZE = 256 * 1024
+# Address space limit for each decoder/encoder process in streaming mode (None - no limit, POSIX only)
+MAX_JOB_MEMORY = 512 * 1024 * 1024
+# How non-FLAC files are copied: 'copy', 'reflink' (falls back to copy) or 'hardlink' (falls back to copy)
+COPY_MODE = 'copy'
+# Skip copying when the destination has the same size and content hash
+SKIP_IDENTICAL = True
+
+# Raw PCM formats used by the streaming mode, by FLAC bits per sample
+PCM_FORMATS = {8: 's16le', 16: 's16le', 24: 's32le', 32: 's32le'}
 
 
 def convert_flac_to_mp3(flac_file_path, mp3_file_path):
@@ -42,6 +93,70 @@ def convert_flac_to_mp3(flac_file_path, mp3_file_path):
     # Load FLAC metadata
     flac_file = FLAC(flac_file_path)
 
+    write_mp3_metadata(flac_file, mp3_file_path)
+
+    print(f"Converted: {flac_file_path} to {mp3_file_path}")
+
+
+def convert_flac_to_mp3_streaming(flac_file_path, mp3_file_path):
+    # FLAC metadata describes the raw PCM stream passed between the two processes
+    flac_file = FLAC(flac_file_path)
+    pcm_format = PCM_FORMATS.get(flac_file.info.bits_per_sample, 's32le')
+    sample_rate = str(flac_file.info.sample_rate)
+    channels = str(flac_file.info.channels)
+
+    decode_command = [AudioSegment.converter, '-nostdin', '-v', 'error', '-i', flac_file_path,
+                      '-map', '0:a:0', '-f', pcm_format, '-']
+    encode_command = [AudioSegment.converter, '-nostdin', '-v', 'error', '-y',
+                      '-f', pcm_format, '-ar', sample_rate, '-ac', channels, '-i', '-',
+                      '-f', 'mp3', '-b:a', '320k', mp3_file_path]
+
+    # Error output goes to temporary files, so that a noisy process can never block on a full pipe
+    with tempfile.TemporaryFile() as decode_errors, tempfile.TemporaryFile() as encode_errors:
+        decoder = subprocess.Popen(decode_command, stdout=subprocess.PIPE, stderr=decode_errors,
+                                   preexec_fn=limit_job_memory if os.name == 'posix' else None)
+        encoder = subprocess.Popen(encode_command, stdin=subprocess.PIPE, stderr=encode_errors,
+                                   preexec_fn=limit_job_memory if os.name == 'posix' else None)
+        encoder_failed = False
+        try:
+            # Only one chunk of PCM is held in memory at a time
+            for chunk in iter(lambda: decoder.stdout.read(STREAM_CHUNK_SIZE), b''):
+                encoder.stdin.write(chunk)
+        except BrokenPipeError:
+            encoder_failed = True  # its error is reported below
+        finally:
+            decoder.stdout.close()
+            # Same as Popen.communicate: the encoder may exit before its input is flushed
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                encoder_failed = True
+            decoder.wait()
+            encoder.wait()
+
+        # The process which failed first is reported, the other one only lost its pipe
+        processes = [(decoder, decode_errors), (encoder, encode_errors)]
+        if encoder_failed:
+            processes.reverse()
+        for process, errors in processes:
+            if process.returncode != 0:
+                errors.seek(0)
+                message = errors.read().decode(errors='replace').strip()
+                raise RuntimeError(f"ffmpeg failed ({process.returncode}) on {flac_file_path}: {message}")
+
+    write_mp3_metadata(flac_file, mp3_file_path)
+
+    print(f"Converted: {flac_file_path} to {mp3_file_path}")
+
+
+# Runs in the decoder/encoder processes before ffmpeg starts
+def limit_job_memory():
+    if MAX_JOB_MEMORY:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (MAX_JOB_MEMORY, MAX_JOB_MEMORY))
+
+
+def write_mp3_metadata(flac_file, mp3_file_path):
     # Open the new MP3 file
     mp3_file = MP3(mp3_file_path, ID3=ID3)
 
@@ -51,8 +166,6 @@ def convert_flac_to_mp3(flac_file_path, mp3_file_path):
     # Save MP3 file with updated metadata
     mp3_file.save()
 
-    print(f"Converted: {flac_file_path} to {mp3_file_path}")
-
 
 def copy_metadata(flac_file, mp3_file):
     if 'TITLE' in flac_file:
@@ -84,30 +197,307 @@ def copy_metadata(flac_file, mp3_file):
         )
 
 
-def copy_converted_files(source_dir, copy_dir, converted_dir):
-    # Create output directories if they don't exist
-    os.makedirs(copy_dir, exist_ok=True)
-    os.makedirs(converted_dir, exist_ok=True)
+def copy_converted_files(source_dir, copy_dir, converted_dir, workers=1, manifest_file=None, use_hash=False,
+                         streaming=False, copy_mode='copy'):
+    manifest = ConversionManifest(manifest_file, use_hash) if manifest_file else None
+
+    if workers > 1:
+        copy_converted_files_parallel(source_dir, copy_dir, converted_dir, workers, manifest=manifest,
+                                      streaming=streaming, copy_mode=copy_mode)
+    else:
+        # Create output directories if they don't exist
+        os.makedirs(copy_dir, exist_ok=True)
+        os.makedirs(converted_dir, exist_ok=True)
+
+        tasks = plan_tasks(source_dir, copy_dir, converted_dir, manifest, streaming, copy_mode)
 
-    file_counter = 0
+        for index, (file_path, task, output_path) in enumerate(tasks):
+            print(f'file_counter = {index + 1}  file = {file_path}')
+            if task is not None:
+                task(file_path, output_path)
+                if manifest:
+                    manifest.record(file_path, output_path)
 
+    if manifest:
+        manifest.remove_deleted_sources()
+        manifest.save()
+
+
+# Lists (file_path, task, output_path) for every file in the source directory in traversal order,
+# task is None for the files which are skipped (artwork and files which are up to date in the manifest)
+def plan_tasks(source_dir, copy_dir, converted_dir, manifest=None, streaming=False, copy_mode='copy'):
+    convert = convert_flac_to_mp3_streaming if streaming else convert_flac_to_mp3
+    copy = functools.partial(copy_file, mode=copy_mode)
+    tasks = []
     # Traverse through all files and subdirectories in the source directory
     for root, dirs, files in os.walk(source_dir):
         for file in files:
             file_path = os.path.join(root, file)
-
-            file_counter += 1
-            print(f'file_counter = {file_counter}  file = {file_path}')
-
             # Check if the file is a .flac file
             if file.lower().endswith('.flac'):
                 # Convert FLAC to MP3 and save in the converted_dir
                 mp3_file_path = os.path.join(converted_dir, f"{os.path.splitext(file)[0]}.mp3")
-                convert_flac_to_mp3(file_path, mp3_file_path)
+                tasks.append((file_path, convert, mp3_file_path))
             elif not file.lower().endswith('.jpg'):  # other files excluding artwork
                 # Copy non-FLAC files to the copy_dir (no folder structure)
-                shutil.copy(file_path, os.path.join(copy_dir, file))
+                tasks.append((file_path, copy, os.path.join(copy_dir, file)))
+            else:
+                tasks.append((file_path, None, None))
+
+            if manifest and tasks[-1][1] is not None and manifest.is_up_to_date(file_path, tasks[-1][2]):
+                tasks[-1] = (file_path, None, None)
+    return tasks
+
+
+# Runs tasks one after another and returns what each of them printed.
+# stdout is replaced for the whole process, so output is captured only in worker processes, never in threads
+def run_tasks(tasks, capture_output=True):
+    outputs = []
+    for task, file_path, output_path in tasks:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output) if capture_output else contextlib.nullcontext():
+            task(file_path, output_path)
+        outputs.append(output.getvalue())
+    return outputs
+
+
+def copy_converted_files_parallel(source_dir, copy_dir, converted_dir, workers=WORKERS, io_workers=IO_WORKERS,
+                                  manifest=None, streaming=False, copy_mode='copy'):
+    # Create output directories if they don't exist
+    os.makedirs(copy_dir, exist_ok=True)
+    os.makedirs(converted_dir, exist_ok=True)
+
+    tasks = plan_tasks(source_dir, copy_dir, converted_dir, manifest, streaming, copy_mode)
+
+    # Files with the same output path (folder structure is not kept) are processed by a single job
+    # in traversal order, so the last one wins just like in the sequential mode
+    jobs = {}
+    for index, (file_path, task, output_path) in enumerate(tasks):
+        if task is not None:
+            job = jobs.setdefault(output_path, {'indexes': [], 'tasks': [], 'size': 0, 'cpu': False})
+            job['indexes'].append(index)
+            job['tasks'].append((task, file_path, output_path))
+            job['size'] += os.path.getsize(file_path)
+            job['cpu'] = job['cpu'] or task in (convert_flac_to_mp3, convert_flac_to_mp3_streaming)
+
+    futures = {}
+    with ProcessPoolExecutor(workers) as cpu_pool, ThreadPoolExecutor(io_workers) as io_pool:
+        # Largest files go first, so that workers finish close together
+        for job in sorted(jobs.values(), key=lambda item: item['size'], reverse=True):
+            if job['cpu']:
+                future = cpu_pool.submit(run_tasks, job['tasks'])
+            else:
+                future = io_pool.submit(run_tasks, job['tasks'], False)
+            if manifest:
+                # Journal the files as soon as their job is done, not when its output is printed
+                future.add_done_callback(lambda done, job_tasks=job['tasks']: record_tasks(manifest, done, job_tasks))
+            for position, index in enumerate(job['indexes']):
+                futures[index] = (future, position)
+
+        # Print the same output as the sequential mode, in traversal order
+        for index, (file_path, task, output_path) in enumerate(tasks):
+            print(f'file_counter = {index + 1}  file = {file_path}')
+            if index in futures:
+                future, position = futures[index]
+                print(future.result()[position], end='')
+
+
+def record_tasks(manifest, future, tasks):
+    if future.exception() is None:
+        for task, file_path, output_path in tasks:
+            manifest.record(file_path, output_path)
+
+
+# Copies a file with permission bits like shutil.copy, but without passing the data through user space
+# whenever the OS allows it. Returns the way the file was copied
+def copy_file(source_path, destination_path, mode='copy', skip_identical=SKIP_IDENTICAL):
+    if skip_identical and is_identical(source_path, destination_path):
+        return 'skipped'
+
+    if mode == 'hardlink' or mode == 'reflink':
+        temp_path = destination_path + '.tmp'
+        try:
+            if mode == 'hardlink':
+                os.link(source_path, temp_path)
+            else:
+                reflink(source_path, temp_path)
+            os.replace(temp_path, destination_path)
+            return mode
+        except OSError:
+            # Different file systems, no support from the file system or the OS - copy instead
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Writing into a hard link would also overwrite the file it shares data with
+    if os.path.exists(destination_path) and os.stat(destination_path).st_nlink > 1:
+        os.remove(destination_path)
+
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        method = copy_file_data(source, destination)
+    shutil.copymode(source_path, destination_path)
+    return method
+
+
+def is_identical(source_path, destination_path):
+    if not os.path.exists(destination_path):
+        return False
+    if os.path.samefile(source_path, destination_path):
+        return True  # hard link made by a previous run
+    if os.path.getsize(source_path) != os.path.getsize(destination_path):
+        return False
+    return hash_file(source_path) == hash_file(destination_path)
+
+
+# Copy-on-write clone (btrfs, XFS, ...) made by the FICLONE ioctl, Linux only
+def reflink(source_path, destination_path):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this OS')
+    import fcntl
+    ficlone = 0x40049409
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), ficlone, source.fileno())
+
+
+def copy_file_data(source, destination):
+    size = os.fstat(source.fileno()).st_size
+    chunk_size = 64 * 1024 * 1024
+
+    # Lets the file system copy (or clone) the data by itself, Linux only
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while copied < size:
+                sent = os.copy_file_range(source.fileno(), destination.fileno(), chunk_size)
+                if sent == 0:
+                    break
+                copied += sent
+            if copied == size:
+                return 'copy_file_range'
+        except OSError:
+            pass  # e.g. not supported between these file systems
+        source.seek(0)
+        destination.seek(0)
+        destination.truncate()
+
+    # Copy inside the kernel, the destination must be a regular file only on Linux
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(destination.fileno(), source.fileno(), offset, chunk_size)
+                if sent == 0:
+                    break
+                offset += sent
+            if offset == size:
+                return 'sendfile'
+        except OSError:
+            pass
+        source.seek(0)
+        destination.seek(0)
+        destination.truncate()
+
+    shutil.copyfileobj(source, destination, 1024 * 1024)
+    return 'copy'
+
+
+def hash_file(file_path):
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Keeps track of the processed source files and the outputs they produced.
+# Every change is appended to a journal first, the manifest itself is rewritten once at the end of a run
+class ConversionManifest:
+    def __init__(self, manifest_file, use_hash=False):
+        self.manifest_file = manifest_file
+        self.journal_file = manifest_file + '.journal'
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.seen_sources = set()
+        self.entries = self.load()
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    def load(self):
+        entries = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        # Replay the journal left by an interrupted run
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # the last line may be cut off by a crash
+                    if record['entry'] is None:
+                        entries.pop(record['source'], None)
+                    else:
+                        entries[record['source']] = record['entry']
+        return entries
+
+    def is_up_to_date(self, file_path, output_path):
+        self.seen_sources.add(file_path)
+        entry = self.entries.get(file_path)
+        if entry is None or entry['output'] != output_path or not os.path.exists(output_path):
+            return False
+
+        stat = os.stat(file_path)
+        if entry['size'] != stat.st_size:
+            return False
+        if entry['mtime'] == stat.st_mtime_ns:
+            return True
+        # Modification time changed (e.g. the file was touched or copied) - compare the content
+        if self.use_hash and entry.get('hash') and entry['hash'] == hash_file(file_path):
+            self.write({'source': file_path, 'entry': dict(entry, mtime=stat.st_mtime_ns)})
+            return True
+        return False
+
+    def record(self, file_path, output_path):
+        stat = os.stat(file_path)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': hash_file(file_path) if self.use_hash else None,
+            'output': output_path
+        }
+        self.write({'source': file_path, 'entry': entry})
+
+    # Deletes outputs of the source files which were not found during this run
+    def remove_deleted_sources(self):
+        deleted_sources = [source for source in self.entries if source not in self.seen_sources]
+        used_outputs = {entry['output'] for source, entry in self.entries.items() if source in self.seen_sources}
+        for source in deleted_sources:
+            output_path = self.entries[source]['output']
+            # Several sources may share an output, since folder structure is not kept
+            if output_path not in used_outputs and os.path.exists(output_path):
+                os.remove(output_path)
+                print(f"Removed: {output_path}")
+            self.write({'source': source, 'entry': None})
+
+    def write(self, record):
+        with self.lock:
+            if record['entry'] is None:
+                self.entries.pop(record['source'], None)
+            else:
+                self.entries[record['source']] = record['entry']
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+
+    def save(self):
+        self.journal.close()
+        # Write to a temporary file first, so that the manifest is never left half-written
+        temp_file = self.manifest_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_file, self.manifest_file)
+        os.remove(self.journal_file)
 
 
 if __name__ == "__main__":
-    copy_converted_files(INPUT_DIRECTORY, OUTPUT_COPY_DIRECTORY, OUTPUT_CONVERTED_DIRECTORY)
+    copy_converted_files(INPUT_DIRECTORY, OUTPUT_COPY_DIRECTORY, OUTPUT_CONVERTED_DIRECTORY, WORKERS, MANIFEST_FILE,
+                         USE_HASH, STREAMING, COPY_MODE)
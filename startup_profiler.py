@@ -0,0 +1,77 @@
+# Cold-start profiler of the player, enabled with the --profile-startup argument.
+# Works both for the source run and for the PyInstaller bundle (player.spec), so it has to be imported
+# by player.py before any other module to see their import times
+import builtins
+import sys
+import time
+
+PROFILE_ARGUMENT = '--profile-startup'
+REPORT_FILE = 'startup_profile.txt'
+TOP_IMPORTS = 25  # number of the slowest imports in the report
+
+
+class StartupProfiler:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        # module name -> [inclusive time, exclusive time]
+        self.import_times = {}
+        self.import_stack = []
+        # (name, seconds since launch) of the startup milestones
+        self.marks = []
+        self.finished = False
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+
+    # measures modules the same way as `python -X importtime`: inclusive time and time without nested imports
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        self.import_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.import_stack.pop()
+            if self.import_stack:
+                self.import_stack[-1] += elapsed
+            times = self.import_times.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed
+            times[1] += elapsed - nested
+
+    def mark(self, name):
+        if not any(mark_name == name for mark_name, _ in self.marks):
+            self.marks.append((name, time.perf_counter() - self.start_time))
+
+    def stop_import_timing(self):
+        if builtins.__import__ == self.timed_import:
+            builtins.__import__ = self.original_import
+
+    def report(self):
+        bundle = 'PyInstaller bundle' if getattr(sys, 'frozen', False) else 'source run'
+        lines = [f'Startup profile ({bundle}), times since launch:', '']
+        lines += [f'{name:<30}{seconds * 1000:10.1f} ms' for name, seconds in self.marks]
+        lines += ['', f'Slowest imports (inclusive / exclusive, top {TOP_IMPORTS}):']
+        slowest = sorted(self.import_times.items(), key=lambda item: item[1][0], reverse=True)[:TOP_IMPORTS]
+        lines += [f'{name:<40}{inclusive * 1000:10.1f} ms{exclusive * 1000:10.1f} ms'
+                  for name, (inclusive, exclusive) in slowest]
+        return '\n'.join(lines)
+
+    # prints the report (a windowed bundle has no console) and saves it to report_dir
+    def finish(self, report_dir=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.stop_import_timing()
+        report = self.report()
+        if sys.stdout:
+            print(report)
+        if report_dir:
+            import os
+            with open(os.path.join(report_dir, REPORT_FILE), 'w') as f:
+                f.write(report + '\n')
+
+
+# Started as soon as this module is imported, None if profiling is off
+profiler = StartupProfiler() if PROFILE_ARGUMENT in sys.argv else None